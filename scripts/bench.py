@@ -0,0 +1,418 @@
+import argparse
+import asyncio
+import calendar
+import itertools
+import json
+import nonebot
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from nonebot.adapters.console import Adapter
+from nonebot.drivers import Driver
+from pathlib import Path
+from types import SimpleNamespace
+from uuid import uuid4
+
+
+# Framework initialize
+nonebot.init()
+
+# Driver
+driver: Driver = nonebot.get_driver()
+driver.register_adapter(Adapter)
+
+# Load plugin
+nonebot.load_plugin("nonebot_plugin_deer_pipe")
+from nonebot_plugin_deer_pipe import database  # noqa: E402
+from nonebot_plugin_deer_pipe.config import plugin_config  # noqa: E402
+from nonebot_plugin_deer_pipe.constants import get_font  # noqa: E402
+from nonebot_plugin_deer_pipe.database import DeerRecord, User  # noqa: E402
+from nonebot_plugin_deer_pipe.image import gen_calendar, gen_rank  # noqa: E402
+from nonebot_plugin_deer_pipe.stats import get_month_stats  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+
+# Calendar shapes: 4, 5 and 6 weeks
+MONTHS = ((2021, 2), (2024, 9), (2022, 10))
+DENSITIES = (0.0, 0.5, 1.0)
+RANK_SIZES = (5, 10, 20)
+
+# Mixed CJK, Latin & emoji texts
+TEXTS = (
+    "2024-09 🦌签到日历",
+    "本月Top10🦌榜",
+    "我的排名：第3名 x86",
+    "@Nickname_昵称🎉✨ 第12/20页",
+)
+
+# Differences below this are noise
+NOISE_MS = 0.05
+
+# Synthetic database shape
+SCENES = 20
+HISTORY_MONTHS = 12
+DAYS_PER_MONTH = 15
+
+
+def measure(func, repeat: int):
+    func()
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started_at) * 1000)
+    return {"median_ms": statistics.median(samples), "min_ms": min(samples)}
+
+
+async def ameasure(func, repeat: int, warmup: bool = True):
+    if warmup:
+        await func()
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - started_at) * 1000)
+    return {"median_ms": statistics.median(samples), "min_ms": min(samples)}
+
+
+def bench_render(repeat: int):
+    rng = random.Random(0)
+
+    for year, month in MONTHS:
+        now = datetime(year, month, 1)
+        days = calendar.monthrange(year, month)[1]
+        for density in DENSITIES:
+            records = {
+                day: rng.choice((1, 1, 2, 3, 12))
+                for day in range(1, days + 1)
+                if rng.random() < density
+            }
+            yield (
+                f"gen_calendar[{year}-{month:02},{density:.0%}]",
+                measure(lambda: gen_calendar(now, records, "bench", None), repeat),
+            )
+
+    for n in RANK_SIZES:
+        rank = [(f"user{i}", None, 100 - i * 3) for i in range(n)]
+        yield (
+            f"gen_rank[{n}]",
+            measure(
+                lambda: gen_rank(rank, f"本月Top{n}🦌榜", 1, "我的排名：第3名 x86"),
+                repeat,
+            ),
+        )
+
+
+def bench_font(repeat: int):
+    font = get_font()
+    img = Image.new("RGBA", (1000, 100))
+    drw = ImageDraw.Draw(img)
+
+    def draw():
+        for text in TEXTS:
+            font.draw(drw, (10, 10), text, fill="black")
+
+    def get_width():
+        for text in TEXTS:
+            font.get_width(text)
+
+    def cold(func):
+        def run():
+            font._runs.clear()
+            font._widths.clear()
+            func()
+
+        return run
+
+    yield ("draw[warm]", measure(draw, repeat))
+    yield ("draw[cold]", measure(cold(draw), repeat))
+    yield ("get_width[warm]", measure(get_width, repeat))
+    yield ("get_width[cold]", measure(cold(get_width), repeat))
+
+
+async def populate(records: int):
+    rng = random.Random(records)
+    now = datetime.now()
+
+    # Months ending at current month
+    months = []
+    for i in range(HISTORY_MONTHS):
+        year, month = divmod(now.year * 12 + now.month - 1 - i, 12)
+        months.append((year, month + 1))
+
+    # Users spread over scenes
+    count = max(1, records // (HISTORY_MONTHS * DAYS_PER_MONTH))
+    users = [
+        {
+            "uuid": uuid4(),
+            "adapter": "bench",
+            "scope": "bench",
+            "scene_id": f"scene{i % SCENES}",
+            "user_id": f"user{i}",
+            "can_be_helped": True,
+        }
+        for i in range(count)
+    ]
+
+    def rows():
+        for user in users:
+            for year, month in months:
+                days = calendar.monthrange(year, month)[1]
+                for day in rng.sample(range(1, days + 1), DAYS_PER_MONTH):
+                    yield {
+                        "uuid": uuid4(),
+                        "user_uuid": user["uuid"],
+                        "year": year,
+                        "month": month,
+                        "day": day,
+                        "count": rng.choice((1, 1, 2, 3)),
+                    }
+
+    async with database._get_session() as db:
+        await db.execute(insert(User), users)
+        chunk = []
+        for row in rows():
+            chunk.append(row)
+            if len(chunk) >= 10000:
+                await db.execute(insert(DeerRecord), chunk)
+                chunk = []
+        if len(chunk) > 0:
+            await db.execute(insert(DeerRecord), chunk)
+        await db.commit()
+
+    return users
+
+
+async def naive_stats(now: datetime, members: list):
+    # One query per member, then loops over day dicts
+    day_counts = [0] * 32
+    stats = {}
+    for user in members:
+        records = await database.get_records(now, user)
+        longest = run = 0
+        for day in range(1, 32):
+            run = run + 1 if day in records else 0
+            longest = max(longest, run)
+        current = 0
+        day = now.day if now.day in records else now.day - 1
+        while day in records:
+            current += 1
+            day -= 1
+        for day, count in records.items():
+            day_counts[day] += count
+        stats[user.user_id] = (sum(records.values()), len(records), longest, current)
+
+    weekdays = [0] * 7
+    for day in range(1, calendar.monthrange(now.year, now.month)[1] + 1):
+        weekdays[calendar.weekday(now.year, now.month, day)] += day_counts[day]
+    return (stats, weekdays)
+
+
+async def bench_database(records: int, repeat: int, directory: Path):
+    path = directory / f"bench-{records}.db"
+    plugin_config.deer_pipe_database_url = f"sqlite+aiosqlite:///{path}"
+    plugin_config.deer_pipe_cleanup_pause = 0
+
+    # Caches outlive engines
+    database._users.clear()
+    database._boards.clear()
+    await database.init_db()
+    try:
+        started_at = time.perf_counter()
+        users = await populate(records)
+        elapsed = time.perf_counter() - started_at
+        print(f"Populated {records} records in {elapsed:.1f}s", file=sys.stderr)
+
+        now = datetime.now()
+        rng = random.Random(0)
+        picked = [rng.choice(users) for _ in range(repeat + 1)]
+
+        def session_of(user: dict):
+            return SimpleNamespace(
+                adapter=user["adapter"],
+                scope=user["scope"],
+                scene=SimpleNamespace(id=user["scene_id"]),
+                user=SimpleNamespace(id=user["user_id"]),
+            )
+
+        sessions = [session_of(i) for i in picked]
+        targets = [await database.get_user(i, i.user.id) for i in sessions]
+
+        next_user = itertools.cycle(targets).__next__
+        yield (
+            "check_in",
+            await ameasure(lambda: database.check_in(now, next_user()), repeat),
+        )
+
+        next_user = itertools.cycle(targets).__next__
+        yield (
+            "get_records",
+            await ameasure(lambda: database.get_records(now, next_user()), repeat),
+        )
+
+        async def rank():
+            session = sessions[0]
+            await database.get_rank(session, now, 10, 0, session.user.id)
+
+        yield ("get_rank[materialized]", await ameasure(rank, repeat))
+
+        next_session = itertools.cycle(sessions).__next__
+
+        async def query_rank():
+            session = next_session()
+            await database._query_rank(session, now, 10, 0, session.user.id)
+
+        yield ("get_rank[query]", await ameasure(query_rank, repeat))
+
+        # Statistics of the first picked scene
+        scene = picked[0]["scene_id"]
+        members = [
+            await database.get_user(session_of(i), i["user_id"])
+            for i in users
+            if i["scene_id"] == scene
+        ]
+        yield (
+            f"stats[naive,{len(members)}]",
+            await ameasure(lambda: naive_stats(now, members), repeat),
+        )
+        yield (
+            f"stats[columnar,{len(members)}]",
+            await ameasure(
+                lambda: get_month_stats(sessions[0], now.year, now.month, now.day),
+                repeat,
+            ),
+        )
+
+        next_session = itertools.cycle(sessions).__next__
+        yield (
+            "rebuild_rank",
+            await ameasure(lambda: database.rebuild_rank(next_session(), now), repeat),
+        )
+
+        # Destructive, run once
+        yield ("cleanup", await ameasure(database.cleanup, 1, False))
+    finally:
+        await database.close_db()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace):
+    results = []
+
+    def add(suite: str, case: str, stats: dict):
+        results.append({"suite": suite, "case": case, **stats})
+        print(f"{suite}/{case}: {stats['median_ms']:.3f}ms", file=sys.stderr)
+
+    if "render" in args.suite:
+        for case, stats in bench_render(args.repeat):
+            add("render", case, stats)
+    if "font" in args.suite:
+        for case, stats in bench_font(args.repeat):
+            add("font", case, stats)
+    if "database" in args.suite:
+        with tempfile.TemporaryDirectory(prefix="deer_pipe_bench_") as directory:
+            for records in args.records:
+                async for case, stats in bench_database(
+                    records, args.repeat, Path(directory)
+                ):
+                    add(f"database@{records}", case, stats)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "time": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float):
+    base = {(i["suite"], i["case"]): i for i in baseline["results"]}
+    regressions = 0
+
+    print(f"{'suite':<18} {'case':<28} {'ms':>10} {'baseline':>10} {'change':>8}")
+    for i in report["results"]:
+        line = f"{i['suite']:<18} {i['case']:<28} {i['median_ms']:>10.3f}"
+        old = base.get((i["suite"], i["case"]))
+        if old is None:
+            print(f"{line} {'-':>10} {'new':>8}")
+            continue
+
+        change = i["median_ms"] / old["median_ms"] - 1 if old["median_ms"] else 0.0
+        mark = ""
+        if change > threshold and i["median_ms"] - old["median_ms"] > NOISE_MS:
+            mark = "  <- regression"
+            regressions += 1
+        print(f"{line} {old['median_ms']:>10.3f} {change:>+8.1%}{mark}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark render & database paths")
+    parser.add_argument(
+        "-s",
+        "--suite",
+        nargs="+",
+        choices=("render", "font", "database"),
+        default=["render", "font", "database"],
+        help="suites to run",
+    )
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="runs per case")
+    parser.add_argument(
+        "-r",
+        "--records",
+        nargs="+",
+        type=int,
+        default=[10_000, 100_000],
+        help="synthetic database sizes",
+    )
+    parser.add_argument("-o", "--output", type=Path, help="save results as JSON")
+    parser.add_argument("-b", "--baseline", type=Path, help="compare with JSON results")
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="slowdown ratio reported as regression",
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline is None:
+        print(json.dumps(report, indent=2))
+        return
+
+    regressions = compare(report, json.loads(args.baseline.read_text()), args.threshold)
+    if regressions > 0:
+        print(f"{regressions} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1)
+
+
+# Main entry
+if __name__ == "__main__":
+    main()
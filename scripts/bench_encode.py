@@ -0,0 +1,78 @@
+import argparse
+import json
+import nonebot
+import random
+import time
+
+from datetime import datetime
+from nonebot.adapters.console import Adapter
+from nonebot.drivers import Driver
+
+
+# Framework initialize
+nonebot.init()
+
+# Driver
+driver: Driver = nonebot.get_driver()
+driver.register_adapter(Adapter)
+
+# Load plugin
+nonebot.load_plugin("nonebot_plugin_deer_pipe")
+from nonebot_plugin_deer_pipe.image import draw_calendar, draw_rank, encode  # noqa: E402
+
+
+# Formats to compare
+FORMATS = ("png", "png8", "webp", "jpeg")
+
+
+def cases():
+    rng = random.Random(0)
+
+    # Typical calendar: about 60% days deered, some multiple times
+    now = datetime(2024, 9, 30)
+    records = {
+        day: rng.choice((1, 1, 1, 2, 3, 12))
+        for day in range(1, 31)
+        if rng.random() < 0.6
+    }
+    yield ("calendar", draw_calendar(now, records, "bench", None))
+
+    # Typical boards
+    for n in (5, 10):
+        rank = [(f"user{i}", None, 100 - i * 7) for i in range(n)]
+        yield (
+            f"rank@{n}",
+            draw_rank(rank, f"本月Top{n}🦌榜", 1, "我的排名：第3名 x86"),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rendered image encoders")
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="encodes per case")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for name, img in cases():
+        for fmt in FORMATS:
+            data = encode(img, fmt)
+            started_at = time.perf_counter()
+            for _ in range(args.repeat):
+                data = encode(img, fmt)
+            elapsed = (time.perf_counter() - started_at) / args.repeat
+            results.append(
+                {"case": name, "format": fmt, "ms": elapsed * 1000, "bytes": len(data)}
+            )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'case':<10} {'format':<6} {'ms':>8} {'bytes':>9}")
+    for i in results:
+        print(f"{i['case']:<10} {i['format']:<6} {i['ms']:>8.2f} {i['bytes']:>9}")
+
+
+# Main entry
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ from . import requirements as requirements
 # Load matchers
 from . import matchers as matchers
 
+from .config import Config
 from nonebot.plugin import PluginMetadata, inherit_supported_adapters
 
 
@@ -14,6 +15,7 @@ __plugin_meta__ = PluginMetadata(
     usage="发送“🦌帮助”以查看插件命令",
     type="application",
     homepage="https://github.com/SamuNatsu/nonebot-plugin-deer-pipe",
+    config=Config,
     supported_adapters=inherit_supported_adapters(
         "nonebot_plugin_alconna",
         "nonebot_plugin_apscheduler",
@@ -0,0 +1,126 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+import asyncio
+import hashlib
+import json
+import time
+
+from .cache import LRUCache, SingleFlight
+from .config import plugin_config
+from .constants import AVATAR_CACHE_PATH
+from .metrics import register_cache, timer
+from .network import fetch
+from PIL import Image
+from io import BytesIO
+from nonebot.log import logger
+
+
+# Avatar size
+AVATAR_SIZE = (80, 80)
+
+# Decoded avatars, revalidated after TTL
+_avatars: LRUCache[str, Image.Image] = LRUCache(
+    1 << 20,
+    ttl=plugin_config.deer_pipe_avatar_ttl,
+    maxbytes=plugin_config.deer_pipe_avatar_cache_bytes,
+    sizeof=lambda img: img.width * img.height * 4,
+)
+_avatar_flight: SingleFlight[str, Image.Image | None] = SingleFlight()
+register_cache("avatars", _avatars)
+
+
+def _digest(img: Image.Image):
+    # Content hash for rendered image fingerprints
+    img.info["digest"] = hashlib.blake2b(img.tobytes(), digest_size=16).hexdigest()
+    return img
+
+
+def _decode(data: bytes):
+    img = Image.open(BytesIO(data)).convert("RGBA").resize(AVATAR_SIZE)
+    img.load()
+    return _digest(img)
+
+
+def _read_disk(path: Path):
+    with Image.open(path) as img:
+        return _digest(img.convert("RGBA"))
+
+
+def _write_disk(path: Path, meta_path: Path, img: Image.Image, meta: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    img.save(tmp, format=plugin_config.deer_pipe_avatar_disk_format)
+    tmp.replace(path)
+    meta_path.write_text(json.dumps(meta))
+
+
+async def _load(url: str):
+    # Disk cache entry
+    name = hashlib.sha1(url.encode()).hexdigest()
+    path = AVATAR_CACHE_PATH / f"{name}.{plugin_config.deer_pipe_avatar_disk_format}"
+    meta_path = AVATAR_CACHE_PATH / f"{name}.json"
+    try:
+        meta = json.loads(meta_path.read_text()) if path.exists() else None
+    except (OSError, ValueError):
+        meta = None
+
+    # Fresh on disk
+    if meta is not None and time.time() - meta["fetched_at"] < _avatars.ttl:
+        return await asyncio.to_thread(_read_disk, path)
+
+    # Revalidate or download
+    headers: dict[str, str] = {}
+    if meta is not None and meta.get("etag") is not None:
+        headers["If-None-Match"] = meta["etag"]
+    if meta is not None and meta.get("last_modified") is not None:
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        with timer("avatar_fetch"):
+            resp = await fetch(url, headers=headers)
+        if resp.status == 304 and meta is not None:
+            img = await asyncio.to_thread(_read_disk, path)
+        elif resp.status == 200:
+            img = await asyncio.to_thread(_decode, resp.body)
+        else:
+            raise ValueError(f"HTTP {resp.status}")
+    except Exception as e:
+        logger.warning(f"Error downloading avatar '{url}': {e!r}")
+
+        # Serve stale avatar if any
+        return None if meta is None else await asyncio.to_thread(_read_disk, path)
+
+    # Save to disk
+    meta = {
+        "url": url,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+    }
+    try:
+        await asyncio.to_thread(_write_disk, path, meta_path, img, meta)
+    except OSError as e:
+        logger.warning(f"Fail to save avatar cache '{path}': {e}")
+    return img
+
+
+async def get_avatar(url: str):
+    """
+    Get 80x80 RGBA avatar from memory cache, disk cache or network
+
+    :param url: Avatar URL
+    :return: Avatar image or None if failed
+    """
+    img = _avatars.get(url)
+    if img is not None:
+        return img
+
+    # Coalesce concurrent loads of the same URL
+    img = await _avatar_flight.do(url, lambda: _load(url))
+    if img is not None:
+        _avatars.put(url, img)
+    return img
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import AsyncIterator, Awaitable, Callable
+
+
+import asyncio
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Generic, TypeVar
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """Thread-safe LRU cache with bounded entry count, optional byte budget and TTL"""
+
+    def __init__(
+        self,
+        maxsize: int,
+        *,
+        ttl: float | None = None,
+        maxbytes: int | None = None,
+        sizeof: Callable[[V], int] | None = None,
+    ):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._sizeof = sizeof or (lambda _: 0)
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key: K):
+        self.nbytes -= self._sizeof(self._data.pop(key)[1])
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: K, value: V):
+        # Non-positive TTL disables caching
+        if self.ttl is not None and self.ttl <= 0:
+            self.pop(key)
+            return
+
+        expires_at = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires_at, value)
+            self.nbytes += self._sizeof(value)
+
+            # Evict least recently used entries
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None
+                and self.nbytes > self.maxbytes
+                and len(self._data) > 1
+            ):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key: K):
+        with self._lock:
+            if key not in self._data:
+                return None
+            value = self._data[key][1]
+            self._remove(key)
+            return value
+
+    def discard_if(self, predicate: Callable[[K], bool]):
+        with self._lock:
+            for key in [i for i in self._data if predicate(i)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+class SingleFlight(Generic[K, V]):
+    """Share one in-flight call among concurrent callers with the same key"""
+
+    def __init__(self):
+        self._calls: dict[K, asyncio.Future[V]] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self._calls[key] = call
+
+            def done(_: asyncio.Future[V]):
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+            call.add_done_callback(done)
+
+        # Cancelling one caller must not cancel the others
+        return await asyncio.shield(call)
+
+
+class KeyedLock(Generic[K]):
+    """FIFO asyncio lock per key, dropped once nobody holds or waits for it"""
+
+    def __init__(self):
+        self._locks: dict[K, tuple[asyncio.Lock, list[int]]] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: K) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = (asyncio.Lock(), [0])
+            self._locks[key] = entry
+
+        lock, users = entry
+        users[0] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            users[0] -= 1
+            if users[0] == 0:
+                del self._locks[key]
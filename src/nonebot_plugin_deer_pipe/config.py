@@ -0,0 +1,78 @@
+from nonebot import get_plugin_config
+from pydantic import BaseModel
+from typing import Literal
+
+
+# Rendered image format
+ImageFormat = Literal["png", "png8", "webp", "jpeg"]
+
+
+class Config(BaseModel):
+    # Rendering
+    deer_pipe_render_executor: Literal["thread", "process"] = "thread"
+    deer_pipe_render_workers: int = 2
+    deer_pipe_render_queue_size: int = 32
+    deer_pipe_calendar_cache_size: int = 4
+    deer_pipe_glyph_cache_size: int = 512
+    deer_pipe_warmup: bool = True
+    deer_pipe_image_format: ImageFormat = "png"
+    deer_pipe_image_format_adapters: dict[str, ImageFormat] = {}
+    deer_pipe_image_compress_level: int = 6
+    deer_pipe_image_quality: int = 85
+    deer_pipe_image_cache_size: int = 1024
+    deer_pipe_image_cache_bytes: int = 32 * 1024 * 1024
+
+    # HTTP client
+    deer_pipe_http_limit: int = 100
+    deer_pipe_http_limit_per_host: int = 10
+    deer_pipe_http_connect_timeout: float = 5.0
+    deer_pipe_http_read_timeout: float = 10.0
+    deer_pipe_http_retries: int = 2
+    deer_pipe_http_backoff: float = 0.5
+    deer_pipe_http_max_size: int = 5 * 1024 * 1024
+
+    # Member info fetching
+    deer_pipe_fetch_concurrency: int = 5
+    deer_pipe_fetch_deadline: float = 5.0
+    deer_pipe_avatar_timeout: float = 3.0
+
+    # Avatar cache
+    deer_pipe_avatar_ttl: float = 86400.0
+    deer_pipe_avatar_cache_bytes: int = 32 * 1024 * 1024
+    deer_pipe_avatar_disk_format: Literal["png", "webp"] = "png"
+
+    # Database
+    deer_pipe_database_url: str | None = None
+    deer_pipe_db_pool_size: int = 5
+    deer_pipe_db_max_overflow: int = 10
+    deer_pipe_db_pool_timeout: float = 30.0
+    deer_pipe_db_journal_mode: Literal["WAL", "DELETE", "TRUNCATE", "MEMORY"] = "WAL"
+    deer_pipe_db_synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    deer_pipe_db_busy_timeout: int = 5000
+    deer_pipe_db_cache_size: int = -16000
+    deer_pipe_db_mmap_size: int = 64 * 1024 * 1024
+    deer_pipe_user_cache_size: int = 4096
+    deer_pipe_user_cache_ttl: float = 3600.0
+    deer_pipe_rank_cache_size: int = 1024
+    deer_pipe_rank_cache_ttl: float = 600.0
+    deer_pipe_rank_materialized: bool = True
+    deer_pipe_rank_size: int = 5
+    deer_pipe_rank_page_size: int = 10
+    deer_pipe_detail_months: int = 1
+    deer_pipe_cleanup_batch_size: int = 500
+    deer_pipe_cleanup_pause: int = 50
+    deer_pipe_ingest_batch_size: int = 1000
+    deer_pipe_export_batch_size: int = 1000
+
+    # Metrics
+    deer_pipe_metrics: bool = False
+    deer_pipe_metrics_path: str = "/deer_pipe/metrics"
+
+    # Write-behind check-ins
+    deer_pipe_write_behind: bool = False
+    deer_pipe_write_behind_interval: int = 1000
+    deer_pipe_write_behind_max_ops: int = 500
+
+
+# Plugin config
+plugin_config = get_plugin_config(Config)
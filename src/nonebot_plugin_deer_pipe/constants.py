@@ -1,26 +1,78 @@
 import nonebot_plugin_localstore as localstore
 
+from .config import plugin_config
 from .font import FontDraw
 from PIL import Image
-from importlib_metadata import version
+from functools import wraps
 from pathlib import Path
+from threading import Lock
+from typing import Callable, TypeVar
 
 
+T = TypeVar("T")
+
 # Plugin info
 PLUGIN_PATH = Path(__file__).parent.resolve()
-PLUGIN_VERSION = version("nonebot_plugin_deer_pipe")
 
 # Assets
 ASSETS_PATH = PLUGIN_PATH / "assets"
-ASSETS_FONT = FontDraw(
-    ASSETS_PATH / "MiSans-Regular.ttf", (ASSETS_PATH / "NotoColorEmoji.ttf", 109)
-)
-ASSETS_IMG_AVATAR = Image.open(ASSETS_PATH / "akkarin@80x80.png").convert("RGBA")
-ASSETS_IMG_CHECK = Image.open(ASSETS_PATH / "check@96x100.png").convert("RGBA")
-ASSETS_IMG_DEERPIPE = Image.open(ASSETS_PATH / "deerpipe@100x82.png").convert("RGBA")
+ASSETS_FONT_INDEX_PATH = localstore.get_plugin_cache_file("font-index.json")
+AVATAR_CACHE_PATH = localstore.get_plugin_cache_dir() / "avatars"
 
 # Database
 DATABASE_VERSION = 3
 DATABASE_NAME = f"userdata-v{DATABASE_VERSION}.db"
 DATABASE_PATH = localstore.get_plugin_data_file(DATABASE_NAME)
 DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+DATABASE_JOURNAL_PATH = localstore.get_plugin_data_file("write-behind.journal")
+EXPORT_PATH = localstore.get_plugin_data_dir() / "exports"
+
+# Lazy loading lock
+_lock = Lock()
+
+
+def _lazy(func: Callable[[], T]) -> Callable[[], T]:
+    """Load value on first call, thread-safely"""
+    loaded: list[T] = []
+
+    @wraps(func)
+    def wrapper():
+        if not loaded:
+            with _lock:
+                if not loaded:
+                    loaded.append(func())
+        return loaded[0]
+
+    return wrapper
+
+
+@_lazy
+def get_plugin_version():
+    from importlib_metadata import version
+
+    return version("nonebot_plugin_deer_pipe")
+
+
+@_lazy
+def get_font():
+    return FontDraw(
+        ASSETS_PATH / "MiSans-Regular.ttf",
+        (ASSETS_PATH / "NotoColorEmoji.ttf", 109),
+        cache_size=plugin_config.deer_pipe_glyph_cache_size,
+        index=ASSETS_FONT_INDEX_PATH,
+    )
+
+
+@_lazy
+def get_img_avatar():
+    return Image.open(ASSETS_PATH / "akkarin@80x80.png").convert("RGBA")
+
+
+@_lazy
+def get_img_check():
+    return Image.open(ASSETS_PATH / "check@96x100.png").convert("RGBA")
+
+
+@_lazy
+def get_img_deerpipe():
+    return Image.open(ASSETS_PATH / "deerpipe@100x82.png").convert("RGBA")
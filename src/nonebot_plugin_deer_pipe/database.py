@@ -3,14 +3,49 @@ from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from nonebot_plugin_uninfo import Session
+    from sqlalchemy import Connection
+    from typing import Any, AsyncIterator, Callable, Iterable
 
 
-from .constants import DATABASE_URL
-from contextlib import asynccontextmanager
-from datetime import datetime
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import asyncio
+import time
+
+from .config import plugin_config
+from .cache import KeyedLock, LRUCache, SingleFlight
+from .constants import DATABASE_JOURNAL_PATH, DATABASE_URL
+from .leaderboard import Leaderboard, SceneKey
+from .metrics import instrument_engine, register_cache, timed
+from .render import invalidate_images
+from .streak import Streak, rebuild, run_from, run_until
+from .writebehind import DayKey, WriteBehindBuffer
+from calendar import monthrange
+from collections import defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from datetime import date, datetime
+from nonebot import get_driver
+from nonebot.log import logger
+from sqlalchemy import (
+    BigInteger,
+    and_,
+    event,
+    exists,
+    inspect,
+    literal,
+    or_,
+    select,
+    tuple_,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlmodel import Field, Index, SQLModel, col, delete, func, update
+from typing import Literal
 from uuid import UUID, uuid4
 
 
@@ -30,31 +65,384 @@ class User(SQLModel, table=True):
 
 
 class DeerRecord(SQLModel, table=True):
-    __table_args__ = (Index("ix_deerrecord_id", "user_uuid", "month", "day"),)
+    __table_args__ = (
+        Index("ix_deerrecord_id", "user_uuid", "year", "month", "day", unique=True),
+        Index("ix_deerrecord_year_month", "year", "month"),
+    )
 
     uuid: UUID = Field(primary_key=True, default_factory=uuid4)
     user_uuid: UUID = Field(foreign_key="user.uuid")
-    month: int = Field(index=True)
+    year: int
+    month: int
     day: int
     count: int = 1
 
 
-# Initialize database engin
-_engine = create_async_engine(DATABASE_URL)
-_initialized = False
+class DeerSummary(SQLModel, table=True):
+    """Compacted deer records of a past month"""
+
+    user_uuid: UUID = Field(foreign_key="user.uuid", primary_key=True)
+    year: int = Field(primary_key=True)
+    month: int = Field(primary_key=True)
+    count: int
+    days: int
+    mask: int | None = Field(default=None, sa_type=BigInteger)
+
+
+class DeerStreak(SQLModel, table=True):
+    """Consecutive check-in days of a user, kept through compaction"""
+
+    user_uuid: UUID = Field(foreign_key="user.uuid", primary_key=True)
+    current: int
+    longest: int
+    last_day: date | None = None
+
+
+class DeerJournal(SQLModel, table=True):
+    """Last write-behind journal segment committed to database"""
+
+    id: int = Field(default=0, primary_key=True)
+    seq: int
+
+
+@dataclass
+class CleanupReport:
+    compacted: int = 0
+    summaries: int = 0
+    users: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+
+
+# Schema version, stored in SQLite `user_version`
+SCHEMA_VERSION = 3
+
+# Unique key of deer record
+_RECORD_KEYS = ["user_uuid", "year", "month", "day"]
+
+# Exportable tables
+ExportTable = Literal["records", "summaries", "users"]
+
+# Backends with `ON CONFLICT` upserts & `RETURNING`
+_DIALECTS = {"sqlite": sqlite, "postgresql": postgresql}
+
+# Database engine
+_engine: AsyncEngine | None = None
+_sessionmaker: async_sessionmaker[AsyncSession] | None = None
+
+# User identity cache
+UserKey = tuple[str, str, str, str]
+_users: LRUCache[UserKey, User] = LRUCache(
+    plugin_config.deer_pipe_user_cache_size, ttl=plugin_config.deer_pipe_user_cache_ttl
+)
+_user_flight: SingleFlight[UserKey, User] = SingleFlight()
+register_cache("users", _users)
+
+# Per-user check-in queue
+_check_in_lock: KeyedLock[UUID] = KeyedLock()
+
+# Materialized leaderboards
+_boards: LRUCache[SceneKey, Leaderboard] = LRUCache(
+    plugin_config.deer_pipe_rank_cache_size, ttl=plugin_config.deer_pipe_rank_cache_ttl
+)
+_board_flight: SingleFlight[SceneKey, Leaderboard] = SingleFlight()
+_board_loads: dict[SceneKey, dict[str, int] | None] = {}
+register_cache("boards", _boards)
+
+# Streaks, dirty ones are written with write-behind check-ins
+_streaks: LRUCache[UUID, Streak] = LRUCache(
+    plugin_config.deer_pipe_user_cache_size, ttl=plugin_config.deer_pipe_user_cache_ttl
+)
+_dirty_streaks: dict[UUID, Streak] = {}
+register_cache("streaks", _streaks)
+
+# Write-behind buffer
+_buffer: WriteBehindBuffer | None = None
+_flush_lock = asyncio.Lock()
+_flush_event = asyncio.Event()
+_flush_task: asyncio.Task[None] | None = None
+
+
+def _insert(model: type[SQLModel]):
+    # Both dialects share the same `on_conflict_*` API
+    assert _engine is not None
+    return _DIALECTS[_engine.dialect.name].insert(model)
+
+
+def _is_shared():
+    # Only server databases can be shared by several instances
+    assert _engine is not None
+    return _engine.dialect.name != "sqlite"
+
+
+def _set_sqlite_pragmas(dbapi_conn: Any, _: Any):
+    cursor = dbapi_conn.cursor()
+    cursor.execute(f"PRAGMA journal_mode={plugin_config.deer_pipe_db_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={plugin_config.deer_pipe_db_synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={plugin_config.deer_pipe_db_busy_timeout:d}")
+    cursor.execute(f"PRAGMA cache_size={plugin_config.deer_pipe_db_cache_size:d}")
+    cursor.execute(f"PRAGMA mmap_size={plugin_config.deer_pipe_db_mmap_size:d}")
+    cursor.close()
+
+
+def _migrate_sqlite(conn: Connection):
+    version = conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+    res = conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type='table'")
+    tables = {i[0] for i in res}
+
+    # v0 -> v1: year column & unique day record
+    if version < 1 and "deerrecord" in tables:
+        columns = {i[1] for i in conn.exec_driver_sql("PRAGMA table_info(deerrecord)")}
+        if "year" not in columns:
+            now = datetime.now()
+            conn.exec_driver_sql("ALTER TABLE deerrecord ADD COLUMN year INTEGER")
+            conn.exec_driver_sql(
+                "UPDATE deerrecord SET year = CASE WHEN month > ? THEN ? ELSE ? END",
+                (now.month, now.year - 1, now.year),
+            )
+
+        # Merge duplicated records into the first one
+        conn.exec_driver_sql(
+            """
+            UPDATE deerrecord SET count = (
+                SELECT SUM(d.count) FROM deerrecord AS d
+                WHERE d.user_uuid = deerrecord.user_uuid AND d.year = deerrecord.year
+                    AND d.month = deerrecord.month AND d.day = deerrecord.day
+            )
+            WHERE rowid IN (
+                SELECT MIN(rowid) FROM deerrecord
+                GROUP BY user_uuid, year, month, day HAVING COUNT(*) > 1
+            )
+            """
+        )
+        conn.exec_driver_sql(
+            """
+            DELETE FROM deerrecord WHERE rowid NOT IN (
+                SELECT MIN(rowid) FROM deerrecord GROUP BY user_uuid, year, month, day
+            )
+            """
+        )
+
+        # Recreate as unique index
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_deerrecord_id")
+        logger.info("Database migrated to schema v1")
+
+    # v1 -> v2: month index replaced by (year, month)
+    if version < 2 and "deerrecord" in tables:
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_deerrecord_month")
+        logger.info("Database migrated to schema v2")
+
+
+def _migrate(conn: Connection):
+    # Only SQLite databases predate the current schema
+    if conn.dialect.name == "sqlite":
+        _migrate_sqlite(conn)
+
+    # v2 -> v3: day bitmask of summaries, unknown for existing ones
+    if inspect(conn).has_table("deersummary"):
+        columns = {i["name"] for i in inspect(conn).get_columns("deersummary")}
+        if "mask" not in columns:
+            conn.exec_driver_sql("ALTER TABLE deersummary ADD COLUMN mask BIGINT")
+            logger.info("Database migrated to schema v3")
+
+    # Streaks of existing records are rebuilt once their table is created
+    rebuild_streaks = not inspect(conn).has_table("deerstreak")
+
+    # Create missing tables & indexes, existing tables don't get new indexes
+    SQLModel.metadata.create_all(conn)
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql(f"PRAGMA user_version={SCHEMA_VERSION:d}")
+    return rebuild_streaks
+
+
+async def init_db():
+    """Create database engine and schema"""
+    global _engine, _sessionmaker
+    if _engine is not None:
+        return
+
+    # Validate backend
+    url = make_url(plugin_config.deer_pipe_database_url or DATABASE_URL)
+    if url.get_backend_name() not in _DIALECTS:
+        raise ValueError(f"Unsupported database backend '{url.get_backend_name()}'")
+
+    # Create engine
+    _engine = create_async_engine(
+        url,
+        pool_size=plugin_config.deer_pipe_db_pool_size,
+        max_overflow=plugin_config.deer_pipe_db_max_overflow,
+        pool_timeout=plugin_config.deer_pipe_db_pool_timeout,
+        pool_pre_ping=url.get_backend_name() != "sqlite",
+    )
+    if _engine.dialect.name == "sqlite":
+        event.listen(_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    instrument_engine(_engine.sync_engine)
+
+    # Migrate & create schema
+    async with _engine.begin() as conn:
+        rebuild_streaks = await conn.run_sync(_migrate)
+
+    _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+    logger.info(f"Database initialized ({_engine.dialect.name})")
+
+    if rebuild_streaks:
+        users = await recompute_streaks()
+        logger.info(f"Streaks rebuilt for {users} users")
+
+    # Start write-behind buffer
+    if plugin_config.deer_pipe_write_behind:
+        await _start_write_behind()
+
+
+async def close_db():
+    """Flush pending check-ins and dispose database engine"""
+    global _engine, _sessionmaker, _buffer, _flush_task
+    if _flush_task is not None:
+        # Never interrupt a flush in progress
+        async with _flush_lock:
+            _flush_task.cancel()
+        _flush_task = None
+    if _buffer is not None:
+        await flush()
+        _buffer.close()
+        _buffer = None
+    if _engine is not None:
+        await _engine.dispose()
+        _engine, _sessionmaker = None, None
+
+
+async def _start_write_behind():
+    global _buffer, _flush_task
+    _buffer = WriteBehindBuffer(DATABASE_JOURNAL_PATH)
+
+    # Replay journal of last run, except segments already committed
+    async with _get_session() as db:
+        committed = await db.scalar(select(col(DeerJournal.seq)))
+    deltas, seq = _buffer.recover(committed or 0)
+    if len(deltas) > 0:
+        await _apply_deltas(deltas, seq=seq)
+        logger.warning(f"Recovered {len(deltas)} day records from write-behind journal")
+
+        # Streak updates aren't journaled
+        await recompute_streaks({i[0] for i in deltas})
+    _buffer.reset()
+
+    async def run():
+        interval = plugin_config.deer_pipe_write_behind_interval / 1000
+        while True:
+            try:
+                await asyncio.wait_for(_flush_event.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            _flush_event.clear()
+
+            try:
+                await flush()
+            except Exception as e:
+                logger.error(f"Fail to flush write-behind check-ins: {e}")
+
+    _flush_task = asyncio.create_task(run())
+
+
+async def _save_streaks(db: AsyncSession, streaks: dict[UUID, Streak]):
+    stmt = _insert(DeerStreak)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_uuid"],
+        set_={
+            "current": stmt.excluded.current,
+            "longest": stmt.excluded.longest,
+            "last_day": stmt.excluded.last_day,
+        },
+    )
+    await db.execute(
+        stmt,
+        [
+            {
+                "user_uuid": user_uuid,
+                "current": streak.current,
+                "longest": streak.longest,
+                "last_day": streak.last_day,
+            }
+            for user_uuid, streak in streaks.items()
+        ],
+    )
+
+
+async def _write_deltas(db: AsyncSession, deltas: dict[DayKey, int]):
+    stmt = _insert(DeerRecord)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=_RECORD_KEYS,
+        set_={"count": col(DeerRecord.count) + stmt.excluded.count},
+    )
+    await db.execute(
+        stmt,
+        [
+            {
+                "uuid": uuid4(),
+                "user_uuid": user_uuid,
+                "year": year,
+                "month": month,
+                "day": day,
+                "count": count,
+            }
+            for (user_uuid, year, month, day), count in deltas.items()
+        ],
+    )
+
+
+async def _apply_deltas(
+    deltas: dict[DayKey, int],
+    streaks: dict[UUID, Streak] | None = None,
+    seq: int | None = None,
+):
+    async with _get_session() as db:
+        if len(deltas) > 0:
+            await _write_deltas(db, deltas)
+        if streaks:
+            await _save_streaks(db, streaks)
+
+        # Mark journal segment committed in the same transaction
+        if seq is not None:
+            stmt = _insert(DeerJournal).values(id=0, seq=seq)
+            await db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["id"], set_={"seq": stmt.excluded.seq}
+                )
+            )
+        await db.commit()
+
+
+@timed("flush")
+async def flush():
+    """Flush pending write-behind check-ins in one transaction"""
+    if _buffer is None:
+        return
+
+    async with _flush_lock:
+        deltas, seq = await _buffer.take()
+        streaks = dict(_dirty_streaks)
+        _dirty_streaks.clear()
+        try:
+            if len(deltas) > 0 or len(streaks) > 0:
+                await _apply_deltas(deltas, streaks, seq)
+        except BaseException:
+            _buffer.done(deltas, False)
+            for user_uuid, streak in streaks.items():
+                _dirty_streaks.setdefault(user_uuid, streak)
+            raise
+        _buffer.done(deltas, True)
 
 
 @asynccontextmanager
 async def _get_session():
-    # Initialize engine
-    global _initialized
-    if not _initialized:
-        async with _engine.begin() as conn:
-            await conn.run_sync(SQLModel.metadata.create_all)
-            _initialized = True
+    if _sessionmaker is None:
+        raise RuntimeError("Database is not initialized")
 
     # Create session
-    async with AsyncSession(_engine) as session:
+    async with _sessionmaker() as session:
         yield session
 
 
@@ -64,6 +452,7 @@ async def _get_records(db: AsyncSession, now: datetime, user: User):
         await db.execute(
             select(col(DeerRecord.day), col(DeerRecord.count))
             .where(col(DeerRecord.user_uuid) == user.uuid)
+            .where(col(DeerRecord.year) == now.year)
             .where(col(DeerRecord.month) == now.month)
         )
     ).all()
@@ -72,71 +461,585 @@ async def _get_records(db: AsyncSession, now: datetime, user: User):
     return {i.tuple()[0]: i.tuple()[1] for i in result}
 
 
-async def cleanup():
-    """Cleanup expired data"""
+def _expired_records(now: datetime):
+    # Day records are kept for recent months only
+    months = now.year * 12 + now.month - 1
+    months -= max(1, plugin_config.deer_pipe_detail_months)
+    year, month = divmod(months, 12)
+    month += 1
+    return or_(
+        col(DeerRecord.year) < year,
+        and_(col(DeerRecord.year) == year, col(DeerRecord.month) <= month),
+    )
+
+
+async def _compact_batch(now: datetime, size: int):
     async with _get_session() as db:
-        now = datetime.now()
+        # Delete a batch first, so the write lock is taken at once
+        res = await db.execute(
+            delete(DeerRecord)
+            .where(
+                col(DeerRecord.uuid).in_(
+                    select(col(DeerRecord.uuid))
+                    .where(_expired_records(now))
+                    .limit(size)
+                )
+            )
+            .returning(
+                col(DeerRecord.user_uuid),
+                col(DeerRecord.year),
+                col(DeerRecord.month),
+                col(DeerRecord.day),
+                col(DeerRecord.count),
+            )
+        )
+        rows = res.all()
+        if len(rows) == 0:
+            return (0, 0)
 
-        # Find expired deer data
-        res1 = (
-            await db.execute(
-                select(col(DeerRecord.user_uuid))
-                .distinct()
-                .where(col(DeerRecord.month) != now.month)
+        # Merge into summaries, partial months add up across batches
+        totals: dict[tuple[UUID, int, int], list[int]] = {}
+        for user_uuid, year, month, day, count in (i.tuple() for i in rows):
+            total = totals.setdefault((user_uuid, year, month), [0, 0, 0])
+            total[0] += count
+            total[1] += 1
+            total[2] |= 1 << day
+        stmt = _insert(DeerSummary)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_uuid", "year", "month"],
+            set_={
+                "count": col(DeerSummary.count) + stmt.excluded.count,
+                "days": col(DeerSummary.days) + stmt.excluded.days,
+                # Unknown mask of a legacy summary stays unknown
+                "mask": col(DeerSummary.mask).op("|")(stmt.excluded.mask),
+            },
+        )
+        await db.execute(
+            stmt,
+            [
+                {
+                    "user_uuid": user_uuid,
+                    "year": year,
+                    "month": month,
+                    "count": count,
+                    "days": days,
+                    "mask": mask,
+                }
+                for (user_uuid, year, month), (count, days, mask) in totals.items()
+            ],
+        )
+        await db.commit()
+
+    return (len(rows), len(totals))
+
+
+async def _delete_orphans_batch(size: int):
+    # Users with neither records nor non-default settings
+    orphaned = (
+        ~exists().where(col(DeerRecord.user_uuid) == col(User.uuid)),
+        ~exists().where(col(DeerSummary.user_uuid) == col(User.uuid)),
+        ~exists().where(col(DeerStreak.user_uuid) == col(User.uuid)),
+        col(User.can_be_helped),
+        col(User.no_deer_until).is_(None),
+    )
+
+    async with _get_session() as db:
+        res = await db.execute(
+            delete(User)
+            .where(
+                col(User.uuid).in_(select(col(User.uuid)).where(*orphaned).limit(size))
             )
-        ).all()
-        set1 = {i.tuple()[0] for i in res1}
+            .returning(
+                col(User.adapter),
+                col(User.scope),
+                col(User.scene_id),
+                col(User.user_id),
+            )
+        )
+        keys = [i.tuple() for i in res.all()]
+        await db.commit()
 
-        # Cleanup expired deer data
-        await db.execute(delete(DeerRecord).where(col(DeerRecord.month) != now.month))
+    # Drop deleted users from cache
+    for key in keys:
+        _users.pop(key)
+    return len(keys)
 
-        # Find active users from deer data
-        res2 = (await db.execute(select(col(DeerRecord.user_uuid)).distinct())).all()
-        set2 = {i.tuple()[0] for i in res2}
 
-        # Cleanup inactive users
-        set3 = set1 - set2
-        await db.execute(delete(User).where(col(User.uuid).in_(set3)))
+@timed("cleanup")
+async def cleanup():
+    """
+    Compact day records of past months into monthly summaries, then delete
+    orphaned users, in bounded batches
+
+    Every batch is committed on its own, an interrupted cleanup resumes
+    from the remaining rows on next run.
+
+    :return: Cleanup report
+    """
+    await flush()
+    now = datetime.now()
+    size = plugin_config.deer_pipe_cleanup_batch_size
+    pause = plugin_config.deer_pipe_cleanup_pause / 1000
+    report = CleanupReport()
+    started_at = logged_at = time.perf_counter()
+
+    def progress():
+        nonlocal logged_at
+        report.batches += 1
+        report.elapsed = time.perf_counter() - started_at
+        if time.perf_counter() - logged_at >= 5:
+            logged_at = time.perf_counter()
+            logger.info(f"Cleanup in progress: {report}")
 
-        # Commit trascation
+    # Compact expired day records
+    while True:
+        records, summaries = await _compact_batch(now, size)
+        if records == 0:
+            break
+        report.compacted += records
+        report.summaries += summaries
+        progress()
+
+        # Let other writers in
+        await asyncio.sleep(pause)
+
+    # Delete orphaned users
+    while True:
+        users = await _delete_orphans_batch(size)
+        if users == 0:
+            break
+        report.users += users
+        progress()
+        await asyncio.sleep(pause)
+
+    report.elapsed = time.perf_counter() - started_at
+    return report
+
+
+async def _recompute_batch(batch: list[UUID]):
+    bit = literal(1, BigInteger).op("<<")(col(DeerRecord.day))
+    async with AsyncExitStack() as stack:
+        # Hold off check-ins of the batch, in sorted order
+        for user_uuid in batch:
+            await stack.enter_async_context(_check_in_lock.hold(user_uuid))
+        await flush()
+
+        async with _get_session() as db:
+            stored = {
+                i.user_uuid: Streak(i.current, i.longest, i.last_day)
+                for i in await db.scalars(
+                    select(DeerStreak).where(col(DeerStreak.user_uuid).in_(batch))
+                )
+            }
+            summaries = await db.execute(
+                select(
+                    col(DeerSummary.user_uuid),
+                    col(DeerSummary.year),
+                    col(DeerSummary.month),
+                    col(DeerSummary.mask),
+                    col(DeerSummary.days),
+                ).where(col(DeerSummary.user_uuid).in_(batch))
+            )
+            records = await db.execute(
+                select(
+                    col(DeerRecord.user_uuid),
+                    col(DeerRecord.year),
+                    col(DeerRecord.month),
+                    func.sum(bit),
+                    func.count(),
+                )
+                .where(col(DeerRecord.user_uuid).in_(batch))
+                .group_by(
+                    col(DeerRecord.user_uuid),
+                    col(DeerRecord.year),
+                    col(DeerRecord.month),
+                )
+            )
+
+            # Months with both summary & records merge their masks, legacy
+            # summaries only have day counts
+            months: defaultdict[UUID, dict[tuple[int, int], tuple[int | None, int]]] = (
+                defaultdict(dict)
+            )
+            for user_uuid, year, month, mask, days in summaries.tuples():
+                months[user_uuid][(year, month)] = (mask, days)
+            for user_uuid, year, month, mask, days in records.tuples():
+                old = months[user_uuid].get((year, month))
+                if old is None:
+                    months[user_uuid][(year, month)] = (int(mask), days)
+                elif old[0] is None:
+                    months[user_uuid][(year, month)] = (None, old[1] + days)
+                else:
+                    months[user_uuid][(year, month)] = (
+                        old[0] | int(mask),
+                        old[1] + days,
+                    )
+
+            streaks = {
+                user_uuid: rebuild(
+                    ((*k, *v) for k, v in sorted(months[user_uuid].items())),
+                    stored.get(user_uuid),
+                )
+                for user_uuid in batch
+            }
+
+            # Users without check-ins have no streak
+            empty = [k for k, v in streaks.items() if v == Streak()]
+            if len(empty) > 0:
+                await db.execute(
+                    delete(DeerStreak).where(col(DeerStreak.user_uuid).in_(empty))
+                )
+            for user_uuid in empty:
+                del streaks[user_uuid]
+            if len(streaks) > 0:
+                await _save_streaks(db, streaks)
+            await db.commit()
+
+        for user_uuid in batch:
+            _dirty_streaks.pop(user_uuid, None)
+            _streaks.put(user_uuid, streaks.get(user_uuid, Streak()))
+
+
+async def recompute_streaks(user_uuids: Iterable[UUID] | None = None):
+    """
+    Rebuild streaks from day records & monthly summaries, in bounded batches
+
+    :param user_uuids: Users to rebuild, all users if not provided
+    :return: Rebuilt user count
+    """
+    size = plugin_config.deer_pipe_cleanup_batch_size
+    pending = None if user_uuids is None else sorted(set(user_uuids))
+    last: UUID | None = None
+    rebuilt = 0
+    while True:
+        # Next batch of users
+        if pending is not None:
+            batch, pending = pending[:size], pending[size:]
+        else:
+            query = select(col(User.uuid)).order_by(col(User.uuid)).limit(size)
+            if last is not None:
+                query = query.where(col(User.uuid) > last)
+            async with _get_session() as db:
+                batch = sorted((await db.scalars(query)).all())
+        if len(batch) == 0:
+            return rebuilt
+
+        last = batch[-1]
+        await _recompute_batch(batch)
+        rebuilt += len(batch)
+
+
+async def ingest_records(rows: list[tuple[UserKey, int, int, int, int]]):
+    """
+    Merge a batch of day records into database, creating missing users
+
+    :param rows: list[tuple[user key, year, month, day, count]]
+    :return: tuple[merged day record count, created user count, set[user UUID]]
+    """
+    # Group user IDs by scene
+    scenes: dict[tuple[str, str, str], set[str]] = {}
+    for (adapter, scope, scene_id, user_id), *_ in rows:
+        scenes.setdefault((adapter, scope, scene_id), set()).add(user_id)
+
+    # Resolve user UUIDs & merge records in one transaction
+    uuids: dict[UserKey, UUID] = {}
+    created = 0
+    deltas: dict[DayKey, int] = {}
+    async with _get_session() as db:
+        for (adapter, scope, scene_id), user_ids in scenes.items():
+            query = (
+                select(col(User.user_id), col(User.uuid))
+                .where(col(User.adapter) == adapter)
+                .where(col(User.scope) == scope)
+                .where(col(User.scene_id) == scene_id)
+            )
+            res = await db.execute(query.where(col(User.user_id).in_(user_ids)))
+            existed = {i.tuple()[0]: i.tuple()[1] for i in res}
+
+            # Create missing users, some may be created concurrently
+            missing = user_ids - existed.keys()
+            if len(missing) > 0:
+                res = await db.execute(
+                    _insert(User)
+                    .on_conflict_do_nothing(
+                        index_elements=["adapter", "scope", "scene_id", "user_id"]
+                    )
+                    .returning(col(User.user_id), col(User.uuid)),
+                    [
+                        {
+                            "uuid": uuid4(),
+                            "adapter": adapter,
+                            "scope": scope,
+                            "scene_id": scene_id,
+                            "user_id": user_id,
+                            "can_be_helped": True,
+                        }
+                        for user_id in missing
+                    ],
+                )
+                inserted = {i.tuple()[0]: i.tuple()[1] for i in res}
+                created += len(inserted)
+                existed.update(inserted)
+
+                # Fetch users created by others
+                missing -= inserted.keys()
+                if len(missing) > 0:
+                    res = await db.execute(query.where(col(User.user_id).in_(missing)))
+                    existed.update({i.tuple()[0]: i.tuple()[1] for i in res})
+
+            for user_id, user_uuid in existed.items():
+                uuids[(adapter, scope, scene_id, user_id)] = user_uuid
+
+        # Merge counts of the same day
+        for key, year, month, day, count in rows:
+            day_key = (uuids[key], year, month, day)
+            deltas[day_key] = deltas.get(day_key, 0) + count
+        await _write_deltas(db, deltas)
         await db.commit()
 
+    # Keep loaded states & caches consistent
+    if _buffer is not None:
+        _buffer.merge(deltas)
+    _discard_boards(lambda key: key[:3] in scenes)
+    invalidate_images(*uuids.values(), *scenes)
+    return (len(deltas), created, set(uuids.values()))
 
-async def get_user(session: Session, user_id: str):
+
+def _export_query(table: ExportTable):
+    user = (col(User.adapter), col(User.scope), col(User.scene_id), col(User.user_id))
+    if table == "users":
+        return (select(*user, col(User.can_be_helped), col(User.no_deer_until)), user)
+
+    # Day records & summaries are ordered by their unique index
+    if table == "summaries":
+        keys = (
+            col(DeerSummary.user_uuid),
+            col(DeerSummary.year),
+            col(DeerSummary.month),
+        )
+        query = select(
+            *user,
+            col(DeerSummary.year),
+            col(DeerSummary.month),
+            col(DeerSummary.count),
+            col(DeerSummary.days),
+        ).join(User, col(User.uuid) == col(DeerSummary.user_uuid))
+        return (query, keys)
+
+    keys = (
+        col(DeerRecord.user_uuid),
+        col(DeerRecord.year),
+        col(DeerRecord.month),
+        col(DeerRecord.day),
+    )
+    query = select(
+        *user,
+        col(DeerRecord.year),
+        col(DeerRecord.month),
+        col(DeerRecord.day),
+        col(DeerRecord.count),
+    ).join(User, col(User.uuid) == col(DeerRecord.user_uuid))
+    return (query, keys)
+
+
+async def export_rows(
+    table: ExportTable, scene: tuple[str, str, str] | None = None, size: int = 1000
+) -> AsyncIterator[list[tuple[Any, ...]]]:
     """
-    Get user
+    Read table rows page by page
+
+    Every page is a keyset query in its own short transaction, so memory stays
+    flat and no lock is held across the export. Rows written meanwhile may or
+    may not be included.
+
+    :param table: Table name
+    :param scene: Only export rows of (adapter, scope, scene ID)
+    :param size: Rows per page
+    :return: Async iterator of row pages
+    """
+    await flush()
+
+    query, keys = _export_query(table)
+    if scene is not None:
+        query = (
+            query.where(col(User.adapter) == scene[0])
+            .where(col(User.scope) == scene[1])
+            .where(col(User.scene_id) == scene[2])
+        )
+    width = len(query.selected_columns)
+    query = query.add_columns(*keys).order_by(*keys).limit(size)
+
+    last: tuple[Any, ...] | None = None
+    while True:
+        page = query if last is None else query.where(tuple_(*keys) > last)
+        async with _get_session() as db:
+            rows = (await db.execute(page)).all()
+        if len(rows) == 0:
+            return
+
+        last = tuple(rows[-1])[width:]
+        yield [tuple(i)[:width] for i in rows]
+        if len(rows) < size:
+            return
+
+
+def _scene_filter(session: Session):
+    return and_(
+        col(User.adapter) == session.adapter,
+        col(User.scope) == session.scope,
+        col(User.scene_id) == session.scene.id,
+    )
+
+
+async def get_scene_month(session: Session, year: int, month: int):
+    """
+    Get per-user & per-day deer aggregates of a scene month
 
     :param session: Uninfo session
-    :param user_id: User ID
-    :return: User
+    :param year: Year
+    :param month: Month
+    :return: tuple[
+        list[tuple[user ID, count, checked days, bitmask of checked days]],
+        list[tuple[day, count, checked users]]
+    ]
     """
+    await flush()
+
+    # Days are distinct per user, so summing bits sets them
+    bit = literal(1, BigInteger).op("<<")(col(DeerRecord.day))
+    month_filter = and_(col(DeerRecord.year) == year, col(DeerRecord.month) == month)
     async with _get_session() as db:
-        # Fetch user
-        user = await db.scalar(
+        users = (
+            await db.execute(
+                select(
+                    col(User.user_id),
+                    func.sum(DeerRecord.count),
+                    func.count(),
+                    func.sum(bit),
+                )
+                .join(User)
+                .where(_scene_filter(session))
+                .where(month_filter)
+                .group_by(col(User.user_id))
+            )
+        ).all()
+        days = (
+            await db.execute(
+                select(col(DeerRecord.day), func.sum(DeerRecord.count), func.count())
+                .join(User)
+                .where(_scene_filter(session))
+                .where(month_filter)
+                .group_by(col(DeerRecord.day))
+            )
+        ).all()
+
+    return (
+        [(i[0], int(i[1]), i[2], int(i[3])) for i in users],
+        [(i[0], int(i[1]), i[2]) for i in days],
+    )
+
+
+async def get_scene_year(session: Session, year: int):
+    """
+    Get per-user monthly deer aggregates of a scene year
+
+    :param session: Uninfo session
+    :param year: Year
+    :return: list[tuple[user ID, month, count, checked days]]
+    """
+    await flush()
+    async with _get_session() as db:
+        # Compacted months
+        res1 = (
+            await db.execute(
+                select(
+                    col(User.user_id),
+                    col(DeerSummary.month),
+                    col(DeerSummary.count),
+                    col(DeerSummary.days),
+                )
+                .join(User)
+                .where(_scene_filter(session))
+                .where(col(DeerSummary.year) == year)
+            )
+        ).all()
+
+        # Recent months
+        res2 = (
+            await db.execute(
+                select(
+                    col(User.user_id),
+                    col(DeerRecord.month),
+                    func.sum(DeerRecord.count),
+                    func.count(),
+                )
+                .join(User)
+                .where(_scene_filter(session))
+                .where(col(DeerRecord.year) == year)
+                .group_by(col(User.user_id), col(DeerRecord.month))
+            )
+        ).all()
+
+    return [(i[0], i[1], int(i[2]), i[3]) for i in [*res1, *res2]]
+
+
+async def _fetch_user(adapter: str, scope: str, scene_id: str, user_id: str):
+    async with _get_session() as db:
+        query = (
             select(User)
-            .where(col(User.adapter) == session.adapter)
-            .where(col(User.scope) == session.scope)
-            .where(col(User.scene_id) == session.scene.id)
+            .where(col(User.adapter) == adapter)
+            .where(col(User.scope) == scope)
+            .where(col(User.scene_id) == scene_id)
             .where(col(User.user_id) == user_id)
         )
 
+        # Fetch user
+        user = await db.scalar(query)
+
         # If user not exists
         if user is None:
-            # Insert new user
-            user = User(
-                adapter=session.adapter,
-                scope=session.scope,
-                scene_id=session.scene.id,
-                user_id=user_id,
-            )
-            db.add(user)
+            # Insert new user, tolerating a concurrent insert
+            await db.execute(
+                _insert(User)
+                .values(
+                    uuid=uuid4(),
+                    adapter=adapter,
+                    scope=scope,
+                    scene_id=scene_id,
+                    user_id=user_id,
+                    can_be_helped=True,
+                )
+                .on_conflict_do_nothing(
+                    index_elements=["adapter", "scope", "scene_id", "user_id"]
+                )
+            )
             await db.commit()
-            await db.refresh(user)
+            user = (await db.scalars(query)).one()
 
-        # Return user
         return user
 
 
+@timed("get_user")
+async def get_user(session: Session, user_id: str):
+    """
+    Get user
+
+    :param session: Uninfo session
+    :param user_id: User ID
+    :return: User
+    """
+    key = (session.adapter, session.scope, session.scene.id, user_id)
+
+    # Fetch user on cache miss, coalescing concurrent fetches
+    user = _users.get(key)
+    if user is None:
+        user = await _user_flight.do(key, lambda: _fetch_user(*key))
+        _users.put(key, user)
+
+    # Return a private copy
+    return User.model_validate(user.model_dump())
+
+
 async def update_user(user: User):
     """
     Update user fields
@@ -144,10 +1047,20 @@ async def update_user(user: User):
     :param user: User
     """
     async with _get_session() as db:
-        db.add(user)
+        await db.execute(
+            update(User)
+            .where(col(User.uuid) == user.uuid)
+            .values(can_be_helped=user.can_be_helped, no_deer_until=user.no_deer_until)
+        )
         await db.commit()
 
+    # Write through user cache
+    key = (user.adapter, user.scope, user.scene_id, user.user_id)
+    _users.put(key, User.model_validate(user.model_dump()))
+    invalidate_images(user.uuid)
+
 
+@timed("get_records")
 async def get_records(now: datetime, user: User):
     """
     Get user deer record map
@@ -156,76 +1069,335 @@ async def get_records(now: datetime, user: User):
     :param user: User
     :return: dict[day of month, count]
     """
+    if _buffer is not None:
+        return await _load_buffered(now, user)
+
     async with _get_session() as db:
         return await _get_records(db, now, user)
 
 
+async def _load_buffered(now: datetime, user: User):
+    assert _buffer is not None
+    key = (user.uuid, now.year, now.month)
+    if key not in _buffer:
+        async with _get_session() as db:
+            _buffer.load(key, await _get_records(db, now, user))
+    return _buffer.get(key) or {}
+
+
+async def _read_streak(db: AsyncSession, user_uuid: UUID):
+    row = await db.get(DeerStreak, user_uuid, populate_existing=True)
+    return Streak() if row is None else Streak(row.current, row.longest, row.last_day)
+
+
+async def get_streak(user: User):
+    """
+    Get user streak without scanning records
+
+    :param user: User
+    :return: Streak
+    """
+    streak = _dirty_streaks.get(user.uuid) or _streaks.get(user.uuid)
+    if streak is None:
+        async with _get_session() as db:
+            streak = await _read_streak(db, user.uuid)
+        _streaks.put(user.uuid, streak)
+    return streak
+
+
+async def _run_before_month(db: AsyncSession, user: User, year: int, month: int):
+    # Walk back through fully checked months
+    length = 0
+    while True:
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+        days = monthrange(year, month)[1]
+
+        # Legacy summaries only know checked day count
+        summary = await db.get(DeerSummary, (user.uuid, year, month))
+        if summary is not None and summary.mask is None:
+            if summary.days < days:
+                return length
+            length += days
+            continue
+
+        # Compacted days & records written after compaction
+        records = None if _buffer is None else _buffer.get((user.uuid, year, month))
+        if records is None:
+            records = await _get_records(db, datetime(year, month, 1), user)
+        mask = sum(1 << i for i in records)
+        if summary is not None and summary.mask is not None:
+            mask |= summary.mask
+        run = run_until(mask, days)
+        length += run
+        if run < days:
+            return length
+
+
+async def _next_streak(
+    db: AsyncSession,
+    streak: Streak,
+    now: datetime,
+    user: User,
+    day: int,
+    records: dict[int, int],
+):
+    # Runs around a past day, the one before may reach into past months
+    checked = date(now.year, now.month, day)
+    mask = sum(1 << i for i in records)
+    before, after = run_until(mask, day - 1), run_from(mask, day + 1)
+    if streak.last_day is not None and checked < streak.last_day and before == day - 1:
+        before += await _run_before_month(db, user, now.year, now.month)
+    return streak.add(checked, before, after)
+
+
+@timed("check_in")
 async def check_in(now: datetime, user: User, day: int | None = None):
     """
-    Check in
+    Check in, serialized per user
 
     :param now: Current time
     :param user: User
     :param day: Past day of current month
     :return: tuple[is success, dict[day of month, count]]
     """
+    async with _check_in_lock.hold(user.uuid):
+        return await _check_in(now, user, day)
+
+
+async def _check_in(now: datetime, user: User, day: int | None):
+    # Apply to write-behind buffer
+    if _buffer is not None:
+        await _load_buffered(now, user)
+        key = (user.uuid, now.year, now.month)
+        ok, records = await _buffer.check_in(key, day or now.day, day is None)
+        if ok:
+            streak = await get_streak(user)
+            async with _get_session() as db:
+                new_streak = await _next_streak(
+                    db, streak, now, user, day or now.day, records
+                )
+            if new_streak != streak:
+                _dirty_streaks[user.uuid] = new_streak
+                _streaks.put(user.uuid, new_streak)
+        if _buffer.pending >= plugin_config.deer_pipe_write_behind_max_ops:
+            _flush_event.set()
+        if ok:
+            _add_to_board(now, user, records)
+            invalidate_images(user.uuid, (user.adapter, user.scope, user.scene_id))
+        return (ok, records)
+
+    # Server databases may be shared with other instances, whose check-ins
+    # the cached streak misses
+    shared = _is_shared()
+    streak = Streak() if shared else await get_streak(user)
     async with _get_session() as db:
+        # Serialize check-ins of the user across instances
+        if shared:
+            await db.execute(
+                select(col(User.uuid))
+                .where(col(User.uuid) == user.uuid)
+                .with_for_update()
+            )
+            streak = await _read_streak(db, user.uuid)
+
+        # Insert record, or increase today's count
+        stmt = _insert(DeerRecord).values(
+            uuid=uuid4(),
+            user_uuid=user.uuid,
+            year=now.year,
+            month=now.month,
+            day=day or now.day,
+            count=1,
+        )
+        if day is None:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=_RECORD_KEYS, set_={"count": col(DeerRecord.count) + 1}
+            )
+        else:
+            # Past day can't be checked twice
+            stmt = stmt.on_conflict_do_nothing(index_elements=_RECORD_KEYS)
+        res = await db.execute(stmt.returning(col(DeerRecord.count)))
+        ok = res.first() is not None
+
         # Get deer records
         records = await _get_records(db, now, user)
 
-        # If check today && today is checked
-        if day is None and now.day in records:
-            records[now.day] += 1
-            await db.execute(
-                update(DeerRecord)
-                .where(col(DeerRecord.user_uuid) == user.uuid)
-                .where(col(DeerRecord.month) == now.month)
-                .where(col(DeerRecord.day) == now.day)
-                .values(count=records[now.day])
+        # Update streak in the same transaction
+        new_streak = streak
+        if ok:
+            new_streak = await _next_streak(
+                db, streak, now, user, day or now.day, records
             )
-            await db.commit()
-            return (True, records)
+            if new_streak != streak:
+                await _save_streaks(db, {user.uuid: new_streak})
+        await db.commit()
 
-        # If check past && past is checked
-        elif day is not None and day in records:
-            return (False, records)
+    if ok:
+        _streaks.put(user.uuid, new_streak)
+        _add_to_board(now, user, records)
+        invalidate_images(user.uuid, (user.adapter, user.scope, user.scene_id))
+    return (ok, records)
 
-        # If check today && today is not checked || check past and past is not checked
-        else:
-            records[day or now.day] = 1
-            db.add(DeerRecord(user_uuid=user.uuid, month=now.month, day=day or now.day))
-            await db.commit()
-            return (True, records)
 
+def _add_to_board(now: datetime, user: User, records: dict[int, int]):
+    if not plugin_config.deer_pipe_rank_materialized:
+        return
+
+    # Monthly totals are idempotent, so a check-in seen by a loading board
+    # query isn't counted twice
+    key = (user.adapter, user.scope, user.scene_id, now.year, now.month)
+    total = sum(records.values())
+    board = _boards.get(key)
+    if board is not None:
+        board.update(user.user_id, total)
+        return
+
+    # Keep totals for the board being loaded
+    pending = _board_loads.get(key)
+    if pending is not None:
+        pending[user.user_id] = max(pending.get(user.user_id, 0), total)
+
+
+def _discard_boards(predicate: Callable[[SceneKey], bool]):
+    _boards.discard_if(predicate)
+
+    # Boards being loaded may miss the change
+    for key in _board_loads:
+        if predicate(key):
+            _board_loads[key] = None
 
-async def get_rank(session: Session, now: datetime):
+
+async def _load_board(key: SceneKey):
+    # Check-ins from now on are kept until the board is cached
+    _board_loads[key] = {}
+    try:
+        # Pending check-ins must be counted
+        await flush()
+
+        adapter, scope, scene_id, year, month = key
+        async with _get_session() as db:
+            res = (
+                await db.execute(
+                    select(col(User.user_id), func.sum(DeerRecord.count))
+                    .join(User)
+                    .where(col(User.adapter) == adapter)
+                    .where(col(User.scope) == scope)
+                    .where(col(User.scene_id) == scene_id)
+                    .where(col(DeerRecord.year) == year)
+                    .where(col(DeerRecord.month) == month)
+                    .group_by(col(User.user_id))
+                )
+            ).all()
+    finally:
+        pending = _board_loads.pop(key)
+
+    # Apply check-ins committed during the query
+    board = Leaderboard({i.tuple()[0]: i.tuple()[1] for i in res})
+    if pending is not None:
+        for user_id, total in pending.items():
+            board.update(user_id, total)
+        _boards.put(key, board)
+    return board
+
+
+async def _get_board(session: Session, now: datetime):
+    key = (session.adapter, session.scope, session.scene.id, now.year, now.month)
+    board = _boards.get(key)
+    if board is None:
+        board = await _board_flight.do(key, lambda: _load_board(key))
+    return board
+
+
+async def rebuild_rank(session: Session, now: datetime):
     """
-    Get rank
+    Rebuild materialized leaderboard from database
 
     :param session: Uninfo session
     :param now: Current time
-    :return: list[tuple[user ID, count]]
+    :return: Ranked user count
     """
+    _boards.pop((session.adapter, session.scope, session.scene.id, now.year, now.month))
+    return len(await _get_board(session, now))
+
+
+async def _query_rank(
+    session: Session, now: datetime, limit: int, offset: int, user_id: str | None
+):
+    # Sum counts of the month
+    totals = (
+        select(
+            col(User.user_id).label("user_id"),
+            func.sum(DeerRecord.count).label("count"),
+        )
+        .join(User)
+        .where(col(User.adapter) == session.adapter)
+        .where(col(User.scope) == session.scope)
+        .where(col(User.scene_id) == session.scene.id)
+        .where(col(DeerRecord.year) == now.year)
+        .where(col(DeerRecord.month) == now.month)
+        .group_by(col(User.user_id))
+        .subquery()
+    )
+
+    # Rank users
+    ranked = select(
+        totals.c.user_id,
+        totals.c.count,
+        func.rank().over(order_by=totals.c.count.desc()).label("rank"),
+        func.row_number()
+        .over(order_by=(totals.c.count.desc(), totals.c.user_id))
+        .label("pos"),
+        func.count().over().label("total"),
+    ).subquery()
+
+    # Fetch page and caller's row at once
     async with _get_session() as db:
-        # Fetch rank of top 5
         res = (
             await db.execute(
-                select(func.sum(DeerRecord.count), col(User.user_id))
-                .join(User)
+                select(ranked)
                 .where(
-                    col(DeerRecord.user_uuid).in_(
-                        select(col(User.uuid))
-                        .where(col(User.adapter) == session.adapter)
-                        .where(col(User.scope) == session.scope)
-                        .where(col(User.scene_id) == session.scene.id)
+                    or_(
+                        ranked.c.pos.between(offset + 1, offset + limit),
+                        ranked.c.user_id == user_id,
                     )
                 )
-                .where(col(DeerRecord.month) == now.month)
-                .group_by(col(DeerRecord.user_uuid))
-                .order_by(func.sum(DeerRecord.count).desc())
-                .limit(5)
+                .order_by(ranked.c.pos)
             )
         ).all()
 
-        # Return rank
-        return [(i.tuple()[1], i.tuple()[0]) for i in res]
+    rows = [i.tuple() for i in res]
+    page = [(i[0], i[1]) for i in rows if offset < i[3] <= offset + limit]
+    own = next(((i[2], i[1]) for i in rows if i[0] == user_id), None)
+    return (page, own, 0 if len(rows) == 0 else rows[0][4])
+
+
+@timed("get_rank")
+async def get_rank(
+    session: Session,
+    now: datetime,
+    limit: int = 5,
+    offset: int = 0,
+    user_id: str | None = None,
+):
+    """
+    Get rank
+
+    :param session: Uninfo session
+    :param now: Current time
+    :param limit: Max entry count
+    :param offset: Entries to skip
+    :param user_id: Optional user ID to get own rank
+    :return: tuple[list[tuple[user ID, count]], tuple[rank, count] | None, total]
+    """
+    if not plugin_config.deer_pipe_rank_materialized:
+        await flush()
+        return await _query_rank(session, now, limit, offset, user_id)
+
+    board = await _get_board(session, now)
+    own = None if user_id is None else board.position(user_id)
+    return (board.top(limit, offset), own, len(board))
+
+
+# Hooks
+get_driver().on_startup(init_db)
+get_driver().on_shutdown(close_db)
@@ -0,0 +1,140 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .database import ExportTable
+    from typing import Any, TextIO
+
+
+import asyncio
+import csv
+import json
+import time
+
+from .config import plugin_config
+from .constants import EXPORT_PATH
+from .database import export_rows
+from dataclasses import dataclass
+from datetime import datetime
+from nonebot.log import logger
+from pathlib import Path
+from typing import Literal
+
+
+# Output format, `columnar` writes one JSON object of column arrays per page
+ExportFormat = Literal["csv", "jsonl", "columnar"]
+
+# File suffix by format
+_SUFFIXES: dict[ExportFormat, str] = {
+    "csv": ".csv",
+    "jsonl": ".jsonl",
+    "columnar": ".columnar.jsonl",
+}
+
+# Column names by table, day records can be imported back as-is
+EXPORT_COLUMNS: dict[ExportTable, tuple[str, ...]] = {
+    "users": (
+        "adapter",
+        "scope",
+        "scene_id",
+        "user_id",
+        "can_be_helped",
+        "no_deer_until",
+    ),
+    "summaries": (
+        "adapter",
+        "scope",
+        "scene_id",
+        "user_id",
+        "year",
+        "month",
+        "count",
+        "days",
+    ),
+    "records": (
+        "adapter",
+        "scope",
+        "scene_id",
+        "user_id",
+        "year",
+        "month",
+        "day",
+        "count",
+    ),
+}
+
+
+@dataclass
+class ExportReport:
+    path: Path
+    rows: int = 0
+    elapsed: float = 0.0
+
+
+def _value(value: Any):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _write(
+    f: TextIO, fmt: ExportFormat, columns: tuple[str, ...], rows: list[tuple[Any, ...]]
+):
+    if fmt == "csv":
+        csv.writer(f).writerows([_value(v) for v in row] for row in rows)
+    elif fmt == "jsonl":
+        f.writelines(
+            json.dumps(dict(zip(columns, map(_value, row))), ensure_ascii=False) + "\n"
+            for row in rows
+        )
+    else:
+        group = {
+            k: [_value(v) for v in values] for k, values in zip(columns, zip(*rows))
+        }
+        f.write(json.dumps(group, ensure_ascii=False) + "\n")
+
+
+async def export_file(
+    table: ExportTable,
+    fmt: ExportFormat = "csv",
+    scene: tuple[str, str, str] | None = None,
+    path: Path | None = None,
+):
+    """
+    Stream table rows into file
+
+    The file is written under a `.part` name and renamed when complete.
+
+    :param table: Table name
+    :param fmt: Output format
+    :param scene: Only export rows of (adapter, scope, scene ID)
+    :param path: Output file, a timestamped file in export directory by default
+    :return: Export report
+    """
+    if path is None:
+        name = f"deer-{table}-{datetime.now():%Y%m%d-%H%M%S}{_SUFFIXES[fmt]}"
+        path = EXPORT_PATH / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part = path.with_name(path.name + ".part")
+
+    report = ExportReport(path)
+    columns = EXPORT_COLUMNS[table]
+    size = max(1, plugin_config.deer_pipe_export_batch_size)
+    started_at = time.perf_counter()
+    try:
+        with part.open("w", newline="", encoding="utf-8") as f:
+            if fmt == "csv":
+                csv.writer(f).writerow(columns)
+
+            # Write pages off the event loop
+            async for rows in export_rows(table, scene, size):
+                await asyncio.to_thread(_write, f, fmt, columns, rows)
+                report.rows += len(rows)
+        part.replace(path)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    report.elapsed = time.perf_counter() - started_at
+
+    logger.info(
+        f"Exported {report.rows} {table} rows to {path} in {report.elapsed:.3f}s"
+    )
+    return report
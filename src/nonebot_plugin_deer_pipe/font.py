@@ -6,19 +6,35 @@ if TYPE_CHECKING:
     from typing import Any
 
 
+import json
+import math
+
+from .cache import LRUCache
+from .metrics import register_cache
 from PIL import Image, ImageDraw, ImageFont
 from fontTools.ttLib import TTFont
+from nonebot.log import logger
+
+
+# Font index format version
+INDEX_VERSION = 1
 
 
 class FontManager:
     def __init__(self, path: Path | tuple[Path, int]):
         self.fixed_size = path[1] if isinstance(path, tuple) else None
-        self._font = ImageFont.truetype(
-            path[0] if isinstance(path, tuple) else path,
-            size=self.fixed_size or 25,
-            layout_engine=ImageFont.Layout.RAQM,
-        )
-        self._cache = {self.fixed_size or 25: self._font}
+        self._path = path[0] if isinstance(path, tuple) else path
+        self._cache: dict[int, ImageFont.FreeTypeFont] = {}
+
+    @property
+    def _font(self):
+        # Load font face on first use
+        size = self.fixed_size or 25
+        if size not in self._cache:
+            self._cache[size] = ImageFont.truetype(
+                self._path, size=size, layout_engine=ImageFont.Layout.RAQM
+            )
+        return self._cache[size]
 
     def _get(self, size: int = 25):
         size = self.fixed_size or size
@@ -63,24 +79,85 @@ class FontManager:
             w, h = int(img.width * scale), int(img.height * scale)
 
             img = img.resize((w, h), Image.Resampling.LANCZOS)
-            draw._image.paste(img, (int(xy[0]), int(xy[1])), mask=img)
+            draw._image.alpha_composite(img, (int(xy[0]), int(xy[1])))
 
 
 class FontDraw:
-    def __init__(self, path: Path | tuple[Path, int], *paths: Path | tuple[Path, int]):
-        self._managers: list[FontManager] = []
-        self._mappings: dict[int, int] = {}
-
+    def __init__(
+        self,
+        path: Path | tuple[Path, int],
+        *paths: Path | tuple[Path, int],
+        cache_size: int = 512,
+        index: Path | None = None,
+    ):
+        fonts = (path, *paths)
+        files = [i[0] if isinstance(i, tuple) else i for i in fonts]
+        self._managers = [FontManager(i) for i in fonts]
+        self._mappings = self._load_mappings(files, index)
+        self._runs: LRUCache[
+            tuple[str, int, tuple[tuple[str, Any], ...]],
+            tuple[Image.Image, int, int],
+        ] = LRUCache(cache_size)
+        self._widths: LRUCache[tuple[str, int], float] = LRUCache(cache_size)
+        register_cache("glyph_runs", self._runs)
+        register_cache("glyph_widths", self._widths)
+
+    @staticmethod
+    def _load_mappings(files: list[Path], index: Path | None):
+        """
+        Load codepoint to font mappings, from index file if it is up to date
+
+        :param files: Font files
+        :param index: Optional index file
+        :return: dict[codepoint, font index]
+        """
+        stats = [(i.name, i.stat()) for i in files]
+        fingerprint = [[name, st.st_size, st.st_mtime_ns] for name, st in stats]
+
+        # Try index file
+        if index is not None and index.exists():
+            try:
+                data = json.loads(index.read_text())
+                if data["version"] == INDEX_VERSION and data["fonts"] == fingerprint:
+                    return {
+                        code: idx
+                        for start, stop, idx in data["ranges"]
+                        for code in range(start, stop)
+                    }
+            except Exception as e:
+                logger.warning(f"Invalid font index '{index}', rebuilding: {e}")
+
+        # Parse cmaps
+        mappings: dict[int, int] = {}
         existed_set: set[int] = set()
-        for idx, path in enumerate((path, *paths)):
-            self._managers.append(FontManager(path))
-
-            cmap = TTFont(path[0] if isinstance(path, tuple) else path).getBestCmap()
+        for idx, file in enumerate(files):
+            cmap = TTFont(file).getBestCmap()
             if cmap is not None:
                 cmap_set = set(cmap.keys())
-                self._mappings.update({i: idx for i in (cmap_set - existed_set)})
+                mappings.update({i: idx for i in (cmap_set - existed_set)})
                 existed_set |= cmap_set
 
+        # Save index file as ranges of consecutive codepoints
+        if index is not None:
+            ranges: list[list[int]] = []
+            for code in sorted(mappings):
+                last = ranges[-1] if ranges else None
+                if last is not None and last[1] == code and last[2] == mappings[code]:
+                    last[1] += 1
+                else:
+                    ranges.append([code, code + 1, mappings[code]])
+            try:
+                data = {
+                    "version": INDEX_VERSION,
+                    "fonts": fingerprint,
+                    "ranges": ranges,
+                }
+                index.write_text(json.dumps(data))
+            except OSError as e:
+                logger.warning(f"Fail to save font index '{index}': {e}")
+
+        return mappings
+
     def _get_chunks(self, text: str):
         chunks = [(char, self._mappings.get(ord(char), 0)) for char in text]
         cluster = chunks[:1]
@@ -91,12 +168,44 @@ class FontDraw:
                 cluster.append((char, idx))
         return cluster
 
+    def _render(self, text: str, size: int, **kwargs: Any):
+        """
+        Render text run onto a transparent image
+
+        :param text: Text
+        :param size: Font size
+        :return: tuple[cropped image, x offset, y offset]
+        """
+        chunks = self._get_chunks(text)
+        margin = size + math.ceil(kwargs.get("stroke_width", 0))
+        w = math.ceil(self.get_width(text, size=size)) + margin * 2
+        img = Image.new("RGBA", (w, (size + margin) * 2), (0, 0, 0, 0))
+        drw = ImageDraw.Draw(img)
+
+        x = float(margin)
+        for text, idx in chunks:
+            font = self._managers[idx]
+            font.draw(drw, (x, margin), text, size=size, **kwargs)
+            box = font.getbbox(text, size=size)
+            x += box[2] - box[0]
+
+        bbox = img.getbbox()
+        if bbox is None:
+            return Image.new("RGBA", (1, 1), (0, 0, 0, 0)), 0, 0
+        return img.crop(bbox), bbox[0] - margin, bbox[1] - margin
+
     def get_width(self, text: str, *, size: int = 25):
+        w = self._widths.get((text, size))
+        if w is not None:
+            return w
+
         w = 0.0
         chunks = self._get_chunks(text)
-        for text, idx in chunks:
-            box = self._managers[idx].getbbox(text, size=size)
+        for chunk, idx in chunks:
+            box = self._managers[idx].getbbox(chunk, size=size)
             w += box[2] - box[0]
+
+        self._widths.put((text, size), w)
         return w
 
     def draw(
@@ -108,10 +217,17 @@ class FontDraw:
         size: int = 25,
         **kwargs: Any,
     ):
-        x, y = xy
-        chunks = self._get_chunks(text)
-        for text, idx in chunks:
-            font = self._managers[idx]
-            font.draw(draw, (x, y), text, size=size, **kwargs)
-            box = font.getbbox(text, size=size)
-            x += box[2] - box[0]
+        # Get cached glyph run
+        key = (text, size, tuple(sorted(kwargs.items())))
+        run = self._runs.get(key)
+        if run is None:
+            run = self._render(text, size, **kwargs)
+            self._runs.put(key, run)
+
+        # Composite glyph run
+        img, dx, dy = run
+        x, y = round(xy[0]) + dx, round(xy[1]) + dy
+        if x < 0 or y < 0:
+            draw._image.paste(img, (x, y), mask=img)
+        else:
+            draw._image.alpha_composite(img, (x, y))
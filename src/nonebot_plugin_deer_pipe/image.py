@@ -9,145 +9,299 @@ import os
 import nonebot_plugin_localstore as localstore
 import secrets
 
-from .constants import (
-    ASSETS_FONT,
-    ASSETS_IMG_AVATAR,
-    ASSETS_IMG_CHECK,
-    ASSETS_IMG_DEERPIPE,
-)
+from .cache import LRUCache
+from .config import ImageFormat, plugin_config
+from .constants import get_font, get_img_avatar, get_img_check, get_img_deerpipe
+from .metrics import register_cache, timed
 from PIL import Image, ImageDraw
 from calendar import monthcalendar
 from datetime import datetime
 from io import BytesIO
 
 
-def gen_calendar(
-    now: datetime, records: dict[int, int], name: str, avatar: bytes | None
+# Calendar cell size
+CELL_W, CELL_H = 100, 100
+
+# Calendar caches
+_calendar_bases: LRUCache[tuple[int, int, int, int], Image.Image] = LRUCache(
+    plugin_config.deer_pipe_calendar_cache_size
+)
+_calendar_patches: LRUCache[int, Image.Image] = LRUCache(64)
+register_cache("calendar_bases", _calendar_bases)
+register_cache("calendar_patches", _calendar_patches)
+
+
+def _get_calendar_base(year: int, month: int):
+    """
+    Get pre-rendered calendar grid without header and checks
+
+    :param year: Year
+    :param month: Month
+    :return: tuple[month calendar, base image]
+    """
+    cld = monthcalendar(year, month)
+    key = (year, month, cld[0].index(1), len(cld))
+
+    # Cache hit
+    base = _calendar_bases.get(key)
+    if base is not None:
+        return cld, base
+
+    # Drop past months on month rollover
+    _calendar_bases.discard_if(lambda k: k[:2] < (year, month))
+
+    # Create image
+    font = get_font()
+    base = Image.new("RGBA", (700, CELL_H * (len(cld) + 1)), "white")
+    drw = ImageDraw.Draw(base)
+
+    # Draw cells
+    for week_idx, week in enumerate(cld):
+        for day_idx, day in enumerate(week):
+            # Skip empty calendar cell
+            if day == 0:
+                continue
+
+            # Draw cell
+            x0, y0 = day_idx * CELL_W, (week_idx + 1) * CELL_H
+            base.paste(get_img_deerpipe(), (x0, y0))
+            font.draw(drw, (x0 + 5, y0 + CELL_H - 35), str(day), fill="black")
+
+    _calendar_bases.put(key, base)
+    return cld, base
+
+
+def _get_calendar_patch(count: int):
+    """
+    Get transparent check overlay of a deered cell
+
+    :param count: Deer count of the day
+    :return: Cell overlay image
+    """
+    count = min(count, 1000)
+
+    # Cache hit
+    patch = _calendar_patches.get(count)
+    if patch is not None:
+        return patch
+
+    # Draw check
+    patch = Image.new("RGBA", (CELL_W, CELL_H), (0, 0, 0, 0))
+    patch.alpha_composite(get_img_check())
+
+    # Draw count if greater than 1
+    if count > 1:
+        font = get_font()
+        txt = "x999+" if count > 999 else f"x{count}"
+        tlen = font.get_width(txt, size=20)
+        font.draw(
+            ImageDraw.Draw(patch),
+            (CELL_W - tlen - 5, CELL_H - 25),
+            txt,
+            size=20,
+            fill="red",
+            stroke_width=1,
+        )
+
+    _calendar_patches.put(count, patch)
+    return patch
+
+
+@timed("draw_calendar")
+def draw_calendar(
+    now: datetime,
+    records: dict[int, int],
+    name: str,
+    avatar: Image.Image | None,
+    streak: tuple[int, int] | None = None,
 ):
     """
-    Generate calendar image
+    Draw calendar image
 
     :param now: Current time
     :param records: dict[day, count]
+    :param name: User name
     :param avatar: Optional user avatar
-    :return: Image bytes
+    :param streak: Optional tuple[current streak, longest streak]
+    :return: Image
     """
-    # Generate current month calendar
-    cld = monthcalendar(now.year, now.month)
-
-    # Image size & calendar cell size
-    IMG_W, IMG_H = 700, 100 * (len(cld) + 1)
-    CELL_W, CELL_H = 100, 100
-
-    # Create image
-    img = Image.new("RGBA", (IMG_W, IMG_H), "white")
+    # Copy pre-rendered month grid
+    cld, base = _get_calendar_base(now.year, now.month)
+    img = base.copy()
     drw = ImageDraw.Draw(img)
+    font = get_font()
 
     # Draw avatar
     if avatar is None:
-        img.paste(ASSETS_IMG_AVATAR, (10, 10))
+        img.paste(get_img_avatar(), (10, 10))
     else:
-        avatar_img = Image.open(BytesIO(avatar)).convert("RGBA").resize((80, 80))
-        img.paste(avatar_img, (10, 10))
+        img.paste(avatar, (10, 10))
 
     # Draw calendar info text
-    ASSETS_FONT.draw(
-        drw, (100, 10), f"{now.year}-{now.month:02} 🦌签到日历", fill="black"
-    )
-    ASSETS_FONT.draw(drw, (100, 40), f"@{name}", fill="black")
+    font.draw(drw, (100, 10), f"{now.year}-{now.month:02} 🦌签到日历", fill="black")
+    font.draw(drw, (100, 40), f"@{name}", fill="black")
+    if streak is not None:
+        font.draw(drw, (100, 70), f"连🦌{streak[0]}天  最长{streak[1]}天", fill="red")
 
-    # Draw cells
+    # Patch deered cells only
     for week_idx, week in enumerate(cld):
         for day_idx, day in enumerate(week):
-            # Skip empty calendar cell
-            if day == 0:
+            if day == 0 or day not in records:
                 continue
 
-            # Cell position
             x0, y0 = day_idx * CELL_W, (week_idx + 1) * CELL_H
+            img.alpha_composite(_get_calendar_patch(records[day]), (x0, y0))
 
-            # Draw cell
-            img.paste(ASSETS_IMG_DEERPIPE, (x0, y0))
-            ASSETS_FONT.draw(drw, (x0 + 5, y0 + CELL_H - 35), str(day), fill="black")
+    return img
 
-            # Skip day if not deered
-            if day not in records:
-                continue
 
-            # Draw check
-            img.paste(ASSETS_IMG_CHECK, (x0, y0), ASSETS_IMG_CHECK)
-
-            # Draw count if greater than 1
-            if records[day] > 1:
-                txt = "x999+" if records[day] > 999 else f"x{records[day]}"
-                tlen = ASSETS_FONT.get_width(txt, size=20)
-                ASSETS_FONT.draw(
-                    drw,
-                    (x0 + CELL_W - tlen - 5, y0 + CELL_H - 25),
-                    txt,
-                    size=20,
-                    fill="red",
-                    stroke_width=1,
-                )
-
-    # Export image to bytes
-    img_bytes = BytesIO()
-    img.save(img_bytes, format="PNG")
-
-    # Save image for development
-    if os.getenv("DEER_PIPE_DEV") is not None:
-        img_path = localstore.get_plugin_cache_file(f"{secrets.token_hex()}.png")
-        img.save(img_path)
-
-    # Return bytes
-    return img_bytes.getvalue()
-
-
-def gen_rank(rank: list[tuple[str, bytes | None, int]]):
+@timed("draw_rank")
+def draw_rank(
+    rank: list[tuple[str, Image.Image | None, int]],
+    title: str = "本月Top5🦌榜",
+    start: int = 1,
+    footer: str | None = None,
+):
     """
-    Generate rank image
+    Draw rank image
 
     :param rank: list[tuple[name, avatar, count]]
-    :return: Image bytes
+    :param title: Title text
+    :param start: Rank position of the first entry
+    :param footer: Optional footer text
+    :return: Image
     """
     # Image size
-    IMG_W, IMG_H = 400, (len(rank) + 1) * 100
+    FOOTER_H = 0 if footer is None else 50
+    IMG_W, IMG_H = 400, (len(rank) + 1) * 100 + FOOTER_H
 
     # Create image
     img = Image.new("RGBA", (IMG_W, IMG_H), "white")
     drw = ImageDraw.Draw(img)
+    font = get_font()
 
     # Draw title
-    tlen = ASSETS_FONT.get_width("本月Top5🦌榜", size=50)
-    ASSETS_FONT.draw(
-        drw, (200 - tlen / 2, 25), "本月Top5🦌榜", size=50, fill="red", stroke_width=1
-    )
+    tlen = font.get_width(title, size=50)
+    font.draw(drw, (200 - tlen / 2, 25), title, size=50, fill="red", stroke_width=1)
 
     # Draw rank
     for idx, (name, avatar, count) in enumerate(rank):
         # Draw avatar
         if avatar is None:
-            img.paste(ASSETS_IMG_AVATAR, (10, (idx + 1) * 100 + 10))
+            img.paste(get_img_avatar(), (10, (idx + 1) * 100 + 10))
         else:
-            avatar_img = Image.open(BytesIO(avatar)).convert("RGBA").resize((80, 80))
-            img.paste(avatar_img, (10, (idx + 1) * 100 + 10))
+            img.paste(avatar, (10, (idx + 1) * 100 + 10))
 
         # Draw name
-        ASSETS_FONT.draw(drw, (100, (idx + 1) * 100 + 10), f"@{name}", fill="black")
+        font.draw(drw, (100, (idx + 1) * 100 + 10), f"@{name}", fill="black")
 
-        # Draw count
-        ASSETS_FONT.draw(
-            drw, (100, (idx + 1) * 100 + 50), f"x{count}", fill="red", stroke_width=0.5
+        # Draw position & count
+        font.draw(
+            drw,
+            (100, (idx + 1) * 100 + 50),
+            f"#{start + idx} x{count}",
+            fill="red",
+            stroke_width=0.5,
         )
 
-    # Export image to bytes
+    # Draw footer
+    if footer is not None:
+        tlen = font.get_width(footer)
+        font.draw(drw, (200 - tlen / 2, IMG_H - 40), footer, fill="black")
+
+    return img
+
+
+@timed("encode")
+def encode(img: Image.Image, fmt: ImageFormat = "png"):
+    """
+    Encode image, dropping the alpha channel of the opaque canvas
+
+    :param img: RGBA image
+    :param fmt: Output format
+    :return: Image bytes
+    """
     img_bytes = BytesIO()
-    img.save(img_bytes, format="PNG")
+    level = plugin_config.deer_pipe_image_compress_level
+    quality = plugin_config.deer_pipe_image_quality
+    rgb = img.convert("RGB")
+    if fmt == "png8":
+        pal = rgb.quantize(256, dither=Image.Dither.NONE)
+        pal.save(img_bytes, format="PNG", compress_level=level)
+    elif fmt == "webp":
+        rgb.save(img_bytes, format="WEBP", quality=quality)
+    elif fmt == "jpeg":
+        rgb.save(img_bytes, format="JPEG", quality=quality, optimize=True)
+    else:
+        rgb.save(img_bytes, format="PNG", compress_level=level)
 
     # Save image for development
     if os.getenv("DEER_PIPE_DEV") is not None:
-        img_path = localstore.get_plugin_cache_file(f"{secrets.token_hex()}.png")
-        img.save(img_path)
+        img_path = localstore.get_plugin_cache_file(f"{secrets.token_hex()}.{fmt}")
+        img_path.write_bytes(img_bytes.getvalue())
 
-    # Return bytes
     return img_bytes.getvalue()
+
+
+def get_image_format(adapter: str) -> ImageFormat:
+    """
+    Get output format for adapter
+
+    :param adapter: Adapter name
+    :return: Image format
+    """
+    return plugin_config.deer_pipe_image_format_adapters.get(
+        adapter, plugin_config.deer_pipe_image_format
+    )
+
+
+def gen_calendar(
+    now: datetime,
+    records: dict[int, int],
+    name: str,
+    avatar: Image.Image | None,
+    fmt: ImageFormat = "png",
+    streak: tuple[int, int] | None = None,
+):
+    """
+    Generate calendar image
+
+    :param now: Current time
+    :param records: dict[day, count]
+    :param name: User name
+    :param avatar: Optional user avatar
+    :param fmt: Output format
+    :param streak: Optional tuple[current streak, longest streak]
+    :return: Image bytes
+    """
+    return encode(draw_calendar(now, records, name, avatar, streak), fmt)
+
+
+def gen_rank(
+    rank: list[tuple[str, Image.Image | None, int]],
+    title: str = "本月Top5🦌榜",
+    start: int = 1,
+    footer: str | None = None,
+    fmt: ImageFormat = "png",
+):
+    """
+    Generate rank image
+
+    :param rank: list[tuple[name, avatar, count]]
+    :param title: Title text
+    :param start: Rank position of the first entry
+    :param footer: Optional footer text
+    :param fmt: Output format
+    :return: Image bytes
+    """
+    return encode(draw_rank(rank, title, start, footer), fmt)
+
+
+def warmup():
+    """Load assets and pre-render current month calendar grid"""
+    now = datetime.now()
+    get_font()
+    get_img_avatar()
+    _get_calendar_base(now.year, now.month)
+    for count in range(1, 3):
+        _get_calendar_patch(count)
@@ -0,0 +1,195 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .database import UserKey
+    from typing import Any, Generator, Iterator
+    from uuid import UUID
+
+
+import asyncio
+import csv
+import itertools
+import json
+import time
+
+from .config import plugin_config
+from .database import ingest_records, recompute_streaks
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import date
+from nonebot.log import logger
+from pathlib import Path
+from typing import Literal
+
+
+# Source format
+IngestFormat = Literal["csv", "jsonl"]
+
+# Format by file suffix
+_SUFFIXES: dict[str, IngestFormat] = {
+    ".csv": "csv",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+}
+
+# Seconds between progress logs
+_PROGRESS_INTERVAL = 5.0
+
+# Invalid rows logged in detail
+_MAX_LOGGED_ROWS = 5
+
+
+class IngestError(Exception):
+    """Ingest source can't be read"""
+
+
+@dataclass
+class IngestReport:
+    rows: int = 0
+    skipped: int = 0
+    records: int = 0
+    users: int = 0
+    elapsed: float = 0.0
+
+
+def _read(path: Path, fmt: IngestFormat) -> Generator[tuple[int, Any], None, None]:
+    with path.open(newline="", encoding="utf-8-sig") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield (reader.line_num, row)
+        else:
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    yield (line_num, line)
+
+
+def _parse(raw: Any, scene: tuple[str, str, str] | None):
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if not isinstance(raw, dict):
+        raise ValueError("row is not an object")
+
+    # User
+    adapter, scope, scene_id = scene or (None, None, None)
+    key: UserKey = (
+        str(raw.get("adapter") or adapter or ""),
+        str(raw.get("scope") or scope or ""),
+        str(raw.get("scene_id") or scene_id or ""),
+        str(raw["user_id"]),
+    )
+    if not all(key):
+        raise ValueError("incomplete user")
+
+    # Date, either ISO date or separated fields
+    if raw.get("date"):
+        day = date.fromisoformat(str(raw["date"]))
+    else:
+        day = date(int(raw["year"]), int(raw["month"]), int(raw["day"]))
+
+    # Count, 1 if missing
+    count = raw.get("count")
+    count = 1 if count in (None, "") else int(count)
+    if count < 1:
+        raise ValueError(f"invalid count {count}")
+
+    return (key, day.year, day.month, day.day, count)
+
+
+def _next_chunk(
+    rows: Iterator[tuple[int, Any]],
+    scene: tuple[str, str, str] | None,
+    size: int,
+    report: IngestReport,
+):
+    chunk: list[tuple[UserKey, int, int, int, int]] = []
+    consumed = 0
+    for line_num, raw in itertools.islice(rows, size):
+        consumed += 1
+        try:
+            chunk.append(_parse(raw, scene))
+        except (KeyError, TypeError, ValueError) as e:
+            report.skipped += 1
+            if report.skipped <= _MAX_LOGGED_ROWS:
+                logger.warning(f"Skip invalid row at line {line_num}: {e!r}")
+    report.rows += consumed
+    return (chunk, consumed)
+
+
+async def ingest_file(
+    path: Path,
+    scene: tuple[str, str, str] | None = None,
+    fmt: IngestFormat | None = None,
+):
+    """
+    Stream deer records from CSV or JSONL file into database
+
+    Each row needs `user_id`, either `date` (ISO format) or `year`, `month` and
+    `day`, and optionally `count` (default 1). `adapter`, `scope` and
+    `scene_id` fall back to the given scene. Counts are added to existing
+    records, and every chunk is committed on its own, so an interrupted import
+    keeps the chunks already written. Streaks of imported users are rebuilt
+    at the end, also when the import is interrupted.
+
+    :param path: Source file
+    :param scene: Default (adapter, scope, scene ID)
+    :param fmt: Source format, detected by file suffix if not provided
+    :raises IngestError: Source can't be read
+    :return: Ingest report
+    """
+    if fmt is None:
+        fmt = _SUFFIXES.get(path.suffix.lower())
+        if fmt is None:
+            raise IngestError(f"Unknown format of file: {path.name}")
+    if not path.is_file():
+        raise IngestError(f"File not found: {path}")
+
+    report = IngestReport()
+    size = max(1, plugin_config.deer_pipe_ingest_batch_size)
+    rows = _read(path, fmt)
+    user_uuids: set[UUID] = set()
+    started_at = logged_at = time.perf_counter()
+    try:
+        while True:
+            # Read & parse off the event loop
+            try:
+                chunk, consumed = await asyncio.to_thread(
+                    _next_chunk, rows, scene, size, report
+                )
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                raise IngestError(f"Fail to read {path.name}: {e}") from e
+            if consumed == 0:
+                break
+
+            # Merge chunk in one transaction
+            if len(chunk) > 0:
+                records, users, uuids = await ingest_records(chunk)
+                report.records += records
+                report.users += users
+                user_uuids |= uuids
+
+            # Report progress
+            now = time.perf_counter()
+            if now - logged_at >= _PROGRESS_INTERVAL:
+                logged_at = now
+                logger.info(
+                    f"Ingesting {path.name}: {report.rows} rows, "
+                    f"{report.rows / (now - started_at):.0f} rows/s"
+                )
+    finally:
+        # A read cancelled mid-chunk still runs in its thread
+        with suppress(ValueError):
+            rows.close()
+
+        # Streaks of merged chunks, even if a later one failed
+        if len(user_uuids) > 0:
+            await recompute_streaks(user_uuids)
+    report.elapsed = time.perf_counter() - started_at
+
+    logger.info(
+        f"Ingested {path.name}: {report.rows} rows ({report.skipped} skipped), "
+        f"{report.records} records, {report.users} new users "
+        f"in {report.elapsed:.3f}s"
+    )
+    return report
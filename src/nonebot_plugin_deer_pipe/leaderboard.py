@@ -0,0 +1,64 @@
+from bisect import bisect_left, insort
+
+
+# Type alias
+SceneKey = tuple[str, str, str, int, int]
+
+
+class Leaderboard:
+    """Monthly deer counts of a scene, kept sorted by count descending"""
+
+    def __init__(self, totals: dict[str, int]):
+        self._totals = dict(totals)
+        self._order = sorted((-count, user_id) for user_id, count in totals.items())
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, user_id: str, count: int = 1):
+        """
+        Increase count of user
+
+        :param user_id: User ID
+        :param count: Increment
+        """
+        old = self._totals.get(user_id)
+        if old is not None:
+            del self._order[bisect_left(self._order, (-old, user_id))]
+
+        new = (old or 0) + count
+        self._totals[user_id] = new
+        insort(self._order, (-new, user_id))
+
+    def update(self, user_id: str, total: int):
+        """
+        Raise count of user to a known total, lower totals are stale
+
+        :param user_id: User ID
+        :param total: Monthly count of user
+        """
+        old = self._totals.get(user_id, 0)
+        if total > old:
+            self.add(user_id, total - old)
+
+    def position(self, user_id: str):
+        """
+        Get rank of user, tied counts share the same rank
+
+        :param user_id: User ID
+        :return: tuple[rank, count] or None if not ranked
+        """
+        count = self._totals.get(user_id)
+        if count is None:
+            return None
+        return (bisect_left(self._order, (-count,)) + 1, count)
+
+    def top(self, limit: int, offset: int = 0):
+        """
+        Get a slice of the board
+
+        :param limit: Max entry count
+        :param offset: Entries to skip
+        :return: list[tuple[user ID, count]]
+        """
+        return [(i[1], -i[0]) for i in self._order[offset : offset + limit]]
@@ -1,21 +1,57 @@
-from .constants import PLUGIN_VERSION
-from .database import check_in, get_records, get_user, update_user
-from .image import gen_calendar, gen_rank
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .database import User
+    from PIL import Image
+
+
+import asyncio
+import time
+
+from .cache import SingleFlight
+from .config import plugin_config
+from .constants import get_plugin_version
+from .database import ExportTable, rebuild_rank, recompute_streaks
+from .export import ExportFormat, export_file
+from .image import get_image_format
+from .ingest import IngestError, ingest_file
+from .metrics import ENABLED as METRICS_ENABLED, observe, render_summary, timer
+from .render import RenderBusyError, render_calendar, render_rank
 from .schedule import get_latest_version
-from .utils import get_member_info, get_member_rank, get_user_info
+from .stats import get_month_stats, get_year_stats
+from .storage import storage
+from .utils import get_member_info, get_member_names, get_member_rank, get_user_info
 from datetime import datetime, timedelta
+from nonebot.matcher import Matcher
+from nonebot.message import run_postprocessor, run_preprocessor
+from nonebot.permission import SUPERUSER
 from nonebot_plugin_alconna import Alconna, Args, Match, on_alconna
 from nonebot_plugin_alconna.uniseg import At, UniMessage
 from nonebot_plugin_uninfo import QryItrface, Uninfo
+from pathlib import Path
 from pytimeparse import parse
 from typing import Literal
 
 
+# Reply texts
+_BUSY_TEXT = "图片生成繁忙，请稍后再试捏"
+
+# Identical concurrent requests keyed by (adapter, scope, scene ID, target)
+_calendar_flight: SingleFlight[tuple[str, str, str, str], bytes] = SingleFlight()
+_rank_flight: SingleFlight[
+    tuple[str, str, str, int], tuple[list[tuple[str, Image.Image | None, int]], int]
+] = SingleFlight()
+
 # Matchers
 _deer = on_alconna(Alconna("🦌", Args["target?", At]), aliases={"鹿"})
 _deer_past = on_alconna(Alconna("补🦌", Args["day", int]), aliases={"补鹿"})
 _deer_calendar = on_alconna(Alconna("🦌历", Args["target?", At]), aliases={"鹿历"})
-_deer_rank = on_alconna(Alconna("🦌榜"), aliases={"鹿榜"})
+_deer_rank = on_alconna(Alconna("🦌榜", Args["page?", int]), aliases={"鹿榜"})
+_deer_stats = on_alconna(
+    Alconna("🦌统计", Args["period?", Literal["月", "年"]]), aliases={"鹿统计"}
+)
+_rebuild_rank = on_alconna(Alconna("重建🦌榜"), aliases={"重建鹿榜"})
 _set_can_be_helped = on_alconna(
     Alconna("帮🦌", Args["can_be_helped", Literal["on", "off"]], Args["target?", At]),
     aliases={"帮鹿"},
@@ -23,8 +59,41 @@ _set_can_be_helped = on_alconna(
 _set_no_deer_until = on_alconna(
     Alconna("禁🦌", Args["target", At], Args["duration?", str]), aliases={"禁鹿"}
 )
+_ingest = on_alconna(
+    Alconna("导入🦌", Args["path", str]), aliases={"导入鹿"}, permission=SUPERUSER
+)
+_export = on_alconna(
+    Alconna(
+        "导出🦌",
+        Args["table?", Literal["records", "summaries", "users"]],
+        Args["fmt?", Literal["csv", "jsonl", "columnar"]],
+    ),
+    aliases={"导出鹿"},
+    permission=SUPERUSER,
+)
+_recompute_streaks = on_alconna(
+    Alconna("重算连🦌"), aliases={"重算连鹿"}, permission=SUPERUSER
+)
+_deer_status = on_alconna(Alconna("🦌状态"), aliases={"鹿状态"}, permission=SUPERUSER)
 _deer_help = on_alconna(Alconna("🦌帮助"), aliases={"鹿帮助"})
 
+# Command names in metrics
+_COMMANDS: dict[type[Matcher], str] = {
+    _deer: "deer",
+    _deer_past: "deer_past",
+    _deer_calendar: "deer_calendar",
+    _deer_rank: "deer_rank",
+    _deer_stats: "deer_stats",
+    _rebuild_rank: "rebuild_rank",
+    _set_can_be_helped: "set_can_be_helped",
+    _set_no_deer_until: "set_no_deer_until",
+}
+
+
+async def _get_streak(now: datetime, user: User):
+    streak = await storage.get_streak(user)
+    return (streak.on(now.date()), streak.longest)
+
 
 # Handlers
 @_deer.handle()
@@ -58,20 +127,32 @@ async def _(session: Uninfo, interface: QryItrface, target: Match[At]):
         ).finish(reply_to=True)
 
     # Check in
-    _, records = await check_in(now, user)
-    img = gen_calendar(now, records, name, avatar)
+    _, records = await storage.check_in(now, user)
+    try:
+        img = await render_calendar(
+            now,
+            records,
+            name,
+            avatar,
+            get_image_format(session.adapter),
+            user.uuid,
+            await _get_streak(now, user),
+        )
+    except RenderBusyError:
+        await UniMessage.text(f"成功🦌了，{_BUSY_TEXT}").finish(reply_to=True)
 
     # Reply
-    if target.available:
-        await (
-            UniMessage.text("成功帮")
-            .at(user_id)
-            .text("🦌了")
-            .image(raw=img)
-            .finish(reply_to=True)
-        )
-    else:
-        await UniMessage.text("成功🦌了").image(raw=img).finish(reply_to=True)
+    with timer("reply"):
+        if target.available:
+            await (
+                UniMessage.text("成功帮")
+                .at(user_id)
+                .text("🦌了")
+                .image(raw=img)
+                .finish(reply_to=True)
+            )
+        else:
+            await UniMessage.text("成功🦌了").image(raw=img).finish(reply_to=True)
 
 
 @_deer_past.handle()
@@ -86,18 +167,32 @@ async def _(session: Uninfo, day: Match[int]):
         await UniMessage.text("不是合法的补🦌日期捏").finish(reply_to=True)
 
     # Check in
-    ok, records = await check_in(now, user, day.result)
-    img = gen_calendar(now, records, name, avatar)
+    ok, records = await storage.check_in(now, user, day.result)
+    try:
+        img = await render_calendar(
+            now,
+            records,
+            name,
+            avatar,
+            get_image_format(session.adapter),
+            user.uuid,
+            await _get_streak(now, user),
+        )
+    except RenderBusyError:
+        await UniMessage.text(
+            f"{'成功补🦌' if ok else '不能补🦌已经🦌过的日子捏'}，{_BUSY_TEXT}"
+        ).finish(reply_to=True)
 
     # Reply
-    if ok:
-        await UniMessage.text("成功补🦌").image(raw=img).finish(reply_to=True)
-    else:
-        await (
-            UniMessage.text("不能补🦌已经🦌过的日子捏")
-            .image(raw=img)
-            .finish(reply_to=True)
-        )
+    with timer("reply"):
+        if ok:
+            await UniMessage.text("成功补🦌").image(raw=img).finish(reply_to=True)
+        else:
+            await (
+                UniMessage.text("不能补🦌已经🦌过的日子捏")
+                .image(raw=img)
+                .finish(reply_to=True)
+            )
 
 
 @_deer_calendar.handle()
@@ -108,36 +203,188 @@ async def _(session: Uninfo, interface: QryItrface, target: Match[At]):
     if target.available and not (session.scene.is_channel or session.scene.is_group):
         _deer_calendar.skip()
 
-    # Get user info
-    if target.available:
-        user_id = target.result.target
-        name, avatar, user = await get_member_info(session, interface, user_id)
-    else:
-        user_id = session.user.id
-        name, avatar, user = await get_user_info(session)
+    async def get_image():
+        # Get user info
+        if target.available:
+            name, avatar, user = await get_member_info(session, interface, user_id)
+        else:
+            name, avatar, user = await get_user_info(session)
 
-    # Get image
-    records = await get_records(now, user)
-    img = gen_calendar(now, records, name, avatar)
+        # Get image
+        records, streak = await asyncio.gather(
+            storage.get_records(now, user), _get_streak(now, user)
+        )
+        return await render_calendar(
+            now,
+            records,
+            name,
+            avatar,
+            get_image_format(session.adapter),
+            user.uuid,
+            streak,
+        )
+
+    # Share with identical requests
+    user_id = target.result.target if target.available else session.user.id
+    key = (session.adapter, session.scope, session.scene.id, user_id)
+    try:
+        img = await _calendar_flight.do(key, get_image)
+    except RenderBusyError:
+        await UniMessage.text(_BUSY_TEXT).finish(reply_to=True)
 
     # Reply
-    await UniMessage.image(raw=img).finish(reply_to=True)
+    with timer("reply"):
+        await UniMessage.image(raw=img).finish(reply_to=True)
 
 
 @_deer_rank.handle()
-async def _(session: Uninfo, interface: QryItrface):
+async def _(session: Uninfo, interface: QryItrface, page: Match[int]):
     now = datetime.now()
+    size = plugin_config.deer_pipe_rank_size
+    page_size = min(size, plugin_config.deer_pipe_rank_page_size)
 
     # Skip non-group scene
     if not (session.scene.is_channel or session.scene.is_group):
         _deer_rank.skip()
 
+    # Validate page
+    page_no = page.result if page.available else 1
+    offset = (page_no - 1) * page_size
+    if page_no < 1 or offset >= size:
+        await UniMessage.text("没有这一页捏").finish(reply_to=True)
+
+    async def get_page():
+        rank, _, total = await get_member_rank(
+            session, interface, now, min(page_size, size - offset), offset
+        )
+        return (rank, total)
+
+    # Get rank page shared with identical requests, and own rank
+    key = (session.adapter, session.scope, session.scene.id, page_no)
+    (rank, total), (_, own, _) = await asyncio.gather(
+        _rank_flight.do(key, get_page),
+        storage.get_rank(session, now, 0, 0, session.user.id),
+    )
+
+    # Pages past ranked users are empty, the first one shows own rank
+    if offset > 0 and offset >= min(total, size):
+        await UniMessage.text("没有这一页捏").finish(reply_to=True)
+    pages = max(1, -(-min(total, size) // page_size))
+    footer = "我本月还没有🦌过" if own is None else f"我的排名：第{own[0]}名 x{own[1]}"
+    if pages > 1:
+        footer = f"第{page_no}/{pages}页  {footer}"
+
     # Get image
-    rank = await get_member_rank(session, interface, now)
-    img = gen_rank(rank)
+    try:
+        img = await render_rank(
+            rank,
+            f"本月Top{size}🦌榜",
+            offset + 1,
+            footer,
+            get_image_format(session.adapter),
+            (session.adapter, session.scope, session.scene.id),
+        )
+    except RenderBusyError:
+        await UniMessage.text(_BUSY_TEXT).finish(reply_to=True)
 
     # Reply
-    await UniMessage.image(raw=img).finish(reply_to=True)
+    with timer("reply"):
+        await UniMessage.image(raw=img).finish(reply_to=True)
+
+
+@_deer_stats.handle()
+async def _(session: Uninfo, interface: QryItrface, period: Match[Literal["月", "年"]]):
+    now = datetime.now()
+
+    # Skip non-group scene
+    if not (session.scene.is_channel or session.scene.is_group):
+        _deer_stats.skip()
+
+    # Yearly statistics
+    if period.available and period.result == "年":
+        year = await get_year_stats(session, now.year)
+        if len(year.user_ids) == 0:
+            await UniMessage.text("本群今年还没有人🦌过捏").finish(reply_to=True)
+
+        total = sum(year.counts)
+        busiest = max(range(1, 13), key=year.month_counts.__getitem__)
+        top = year.top(year.days)
+        names = await get_member_names(session, interface, [year.user_ids[top]])
+        own = year.index(session.user.id)
+        months = " ".join(
+            f"{i}月{year.month_counts[i]}" for i in range(1, now.month + 1)
+        )
+        await UniMessage.text(
+            f"== {now.year}年本群🦌统计 ==\n"
+            f"参与人数：{len(year.user_ids)}人，共🦌{total}次，"
+            f"人均{total / len(year.user_ids):.1f}次\n"
+            f"最活跃的月份：{busiest}月（{year.month_counts[busiest]}次）\n"
+            f"🦌得最勤：{names[year.user_ids[top]]}（{year.days[top]}天）\n"
+            f"月份分布：{months}\n"
+            + (
+                "我今年还没有🦌过"
+                if own is None
+                else f"我：{year.counts[own]}次，{year.days[own]}天"
+            )
+        ).finish(reply_to=True)
+
+    # Monthly statistics
+    month = await get_month_stats(session, now.year, now.month, now.day)
+    if len(month.user_ids) == 0:
+        await UniMessage.text("本群本月还没有人🦌过捏").finish(reply_to=True)
+
+    total = sum(month.counts)
+    busiest = month.busiest_day()
+    longest = month.top(month.longest)
+    current = month.top(month.current)
+    names = await get_member_names(
+        session, interface, [month.user_ids[longest], month.user_ids[current]]
+    )
+    weekdays = " ".join(f"{n}{c}" for n, c in zip("一二三四五六日", month.weekdays()))
+    lines = [
+        f"== {now.year}年{now.month}月本群🦌统计 ==",
+        f"参与人数：{len(month.user_ids)}人，共🦌{total}次，"
+        f"人均{total / len(month.user_ids):.1f}次",
+        f"最活跃的一天：{now.month}月{busiest}日"
+        f"（{month.day_counts[busiest]}次，{month.day_users[busiest]}人）",
+        f"星期分布：{weekdays}",
+        f"最长连🦌：{names[month.user_ids[longest]]}（{month.longest[longest]}天）",
+    ]
+    if month.current[current] > 0:
+        lines.append(
+            f"正在连🦌：{names[month.user_ids[current]]}（{month.current[current]}天）"
+        )
+
+    own = month.index(session.user.id)
+    if own is None:
+        lines.append("我本月还没有🦌过")
+    else:
+        lines.append(
+            f"我：{month.counts[own]}次，{month.days[own]}天，"
+            f"最长连🦌{month.longest[own]}天，正在连🦌{month.current[own]}天"
+        )
+    await UniMessage.text("\n".join(lines)).finish(reply_to=True)
+
+
+@_rebuild_rank.handle()
+async def _(session: Uninfo):
+    now = datetime.now()
+
+    # Skip non-group scene
+    if (
+        not (session.scene.is_channel or session.scene.is_group)
+        or session.member is None
+        or session.member.role is None
+    ):
+        _rebuild_rank.skip()
+
+    # Validate admin
+    if session.member.role.level <= 1:
+        await UniMessage.text("权限不足").finish(reply_to=True)
+
+    # Rebuild
+    count = await rebuild_rank(session, now)
+    await UniMessage.text(f"已重建本月🦌榜，共{count}人上榜").finish(reply_to=True)
 
 
 @_set_can_be_helped.handle()
@@ -158,12 +405,12 @@ async def _(
 
     # Get user info
     user_id = target.result.target if target.available else session.user.id
-    user = await get_user(session, user_id)
+    user = await storage.get_user(session, user_id)
 
     # Update user
     allowed = can_be_helped.result == "on"
     user.can_be_helped = allowed
-    await update_user(user)
+    await storage.update_user(user)
 
     # Reply
     if target.available:
@@ -202,7 +449,7 @@ async def _(session: Uninfo, target: Match[At], duration: Match[str]):
 
     # Get user info
     user_id = target.result.target
-    user = await get_user(session, user_id)
+    user = await storage.get_user(session, user_id)
 
     # Validate dur
     dur = parse(duration.result) if duration.available else None
@@ -213,7 +460,7 @@ async def _(session: Uninfo, target: Match[At], duration: Match[str]):
 
     until = None if dur is None else now + timedelta(seconds=dur)
     user.no_deer_until = until
-    await update_user(user)
+    await storage.update_user(user)
 
     # Reply
     if until is None:
@@ -227,30 +474,110 @@ async def _(session: Uninfo, target: Match[At], duration: Match[str]):
         )
 
 
+@_ingest.handle()
+async def _(session: Uninfo, path: Match[str]):
+    # Rows without scene fall back to current group
+    scene = None
+    if session.scene.is_channel or session.scene.is_group:
+        scene = (session.adapter, session.scope, session.scene.id)
+
+    await UniMessage.text("开始导入🦌记录，请稍候").send(reply_to=True)
+    try:
+        report = await ingest_file(Path(path.result), scene)
+    except IngestError as e:
+        await UniMessage.text(f"导入失败：{e}").finish(reply_to=True)
+
+    speed = report.rows / report.elapsed if report.elapsed else 0
+    await UniMessage.text(
+        f"导入完成：读取{report.rows}行（跳过{report.skipped}行），"
+        f"写入{report.records}条记录，新建{report.users}个用户，"
+        f"耗时{report.elapsed:.1f}秒（{speed:.0f}行/秒）"
+    ).finish(reply_to=True)
+
+
+@_export.handle()
+async def _(session: Uninfo, table: Match[ExportTable], fmt: Match[ExportFormat]):
+    # Export current group only, or everything in private chat
+    scene = None
+    if session.scene.is_channel or session.scene.is_group:
+        scene = (session.adapter, session.scope, session.scene.id)
+
+    report = await export_file(
+        table.result if table.available else "records",
+        fmt.result if fmt.available else "csv",
+        scene,
+    )
+    await UniMessage.text(
+        f"导出完成：{report.rows}行，耗时{report.elapsed:.1f}秒\n{report.path}"
+    ).finish(reply_to=True)
+
+
+@_recompute_streaks.handle()
+async def _():
+    started_at = time.perf_counter()
+    users = await recompute_streaks()
+    elapsed = time.perf_counter() - started_at
+    await UniMessage.text(
+        f"已从🦌记录重算{users}个用户的连🦌天数，耗时{elapsed:.1f}秒"
+    ).finish(reply_to=True)
+
+
+@_deer_status.handle()
+async def _():
+    await UniMessage.text(render_summary()).finish(reply_to=True)
+
+
 @_deer_help.handle()
 async def _():
+    plugin_version = get_plugin_version()
     latest_version = get_latest_version()
     await (
-        UniMessage.text(f"== 🦌管插件 v{PLUGIN_VERSION} 帮助 ==\n")
+        UniMessage.text(f"== 🦌管插件 v{plugin_version} 帮助 ==\n")
         .text("[🦌] 🦌管1次\n")
         .text("[🦌 @xxx] 帮xxx🦌管1次（仅群组）\n")
         .text("[补🦌 x] 补🦌本月x日\n")
         .text("[🦌历] 看本月🦌日历\n")
         .text("[🦌历 @xxx] 看xxx的本月🦌日历（仅群组）\n")
-        .text("[🦌榜] 看本月本群🦌排行榜（仅群组）\n")
+        .text("[🦌榜 [x]] 看本月本群🦌排行榜第x页（仅群组）\n")
+        .text("[🦌统计 [月|年]] 看本群本月/今年🦌统计（仅群组）\n")
+        .text("[重建🦌榜] 从数据库重新统计本月本群🦌排行榜（仅群组管理员）\n")
         .text("[帮🦌 <on|off>] 禁止/允许别人帮🦌（仅群组）\n")
         .text("[帮🦌 <on|off> @xxx] 禁止/允许别人帮xxx🦌（仅群组管理员）\n")
         .text(
             "[禁🦌 @xxx [yyy]] xxx接下来一段时间yyy内禁止🦌，不提供yyy时视为解禁（仅群组管理员，yyy为pytimeparse时间段表达式）\n"
         )
+        .text(
+            "[导入🦌 path] 从CSV/JSONL文件批量导入🦌记录，不含群组的记录导入本群（仅超级用户）\n"
+        )
+        .text(
+            "[导出🦌 [records|summaries|users] [csv|jsonl|columnar]] 导出本群（私聊时为全部）的🦌记录/月度汇总/用户到数据目录（仅超级用户）\n"
+        )
+        .text("[重算连🦌] 从🦌记录重新计算所有用户的连🦌天数（仅超级用户）\n")
+        .text("[🦌状态] 查看插件运行状态（仅超级用户）\n")
         .text("[🦌帮助] 打开帮助\n\n")
         .text("* 以上命令中的“🦌”均可换成“鹿”字\n\n")
         .text("== 插件代码仓库 ==\n")
         .text("https://github.com/SamuNatsu/nonebot-plugin-deer-pipe")
         .text(
             ""
-            if PLUGIN_VERSION == latest_version
+            if plugin_version == latest_version
             else f"\n\n* 有新版本可用：v{latest_version}"
         )
         .finish(reply_to=True)
     )
+
+
+# Hooks
+if METRICS_ENABLED:
+
+    @run_preprocessor
+    async def _(matcher: Matcher):
+        if type(matcher) in _COMMANDS:
+            matcher.state["deer_pipe_started_at"] = time.perf_counter()
+
+    @run_postprocessor
+    async def _(matcher: Matcher):
+        started_at = matcher.state.get("deer_pipe_started_at")
+        if started_at is not None:
+            elapsed = time.perf_counter() - started_at
+            observe("command", _COMMANDS[type(matcher)], elapsed)
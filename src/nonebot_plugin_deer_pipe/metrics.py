@@ -0,0 +1,272 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .cache import LRUCache
+    from sqlalchemy import Engine
+    from typing import Any, Callable, Iterator, TypeVar
+
+    F = TypeVar("F", bound=Callable[..., Any])
+
+
+import functools
+import inspect
+import threading
+import time
+
+from .config import plugin_config
+from contextlib import contextmanager, nullcontext
+from nonebot import get_driver
+from nonebot.drivers import ASGIMixin, HTTPServerSetup, Request, Response, URL
+from nonebot.log import logger
+from sqlalchemy import event
+from typing import cast
+
+
+# Whether timers are recorded, decided once at load
+ENABLED = plugin_config.deer_pipe_metrics
+
+# Global variables
+_lock = threading.Lock()
+_series: dict[tuple[str, str], list[float]] = {}
+_caches: dict[str, LRUCache[Any, Any]] = {}
+_collectors: dict[str, Callable[[], dict[str, float]]] = {}
+_null = nullcontext()
+
+
+def observe(family: str, label: str, seconds: float):
+    """
+    Record a duration sample
+
+    :param family: Series family, `command`, `stage` or `query`
+    :param label: Series label
+    :param seconds: Duration
+    """
+    if not ENABLED:
+        return
+
+    with _lock:
+        series = _series.get((family, label))
+        if series is None:
+            series = _series[(family, label)] = [0, 0.0, 0.0]
+        series[0] += 1
+        series[1] += seconds
+        series[2] = max(series[2], seconds)
+
+
+@contextmanager
+def _timer(label: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage", label, time.perf_counter() - started_at)
+
+
+def timer(label: str):
+    """
+    Time a block as a stage, no-op when metrics are disabled
+
+    :param label: Stage name
+    :return: Context manager
+    """
+    return _timer(label) if ENABLED else _null
+
+
+def timed(label: str) -> Callable[[F], F]:
+    """
+    Time every call of a function as a stage, the function is returned as-is
+    when metrics are disabled
+
+    :param label: Stage name
+    :return: Decorator
+    """
+
+    def decorator(func: F) -> F:
+        if not ENABLED:
+            return func
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any):
+                with _timer(label):
+                    return await func(*args, **kwargs)
+
+            return cast("F", async_wrapper)
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any):
+            with _timer(label):
+                return func(*args, **kwargs)
+
+        return cast("F", wrapper)
+
+    return decorator
+
+
+def instrument_engine(engine: Engine):
+    """
+    Count & time database queries by statement type
+
+    :param engine: Sync engine
+    """
+    if not ENABLED:
+        return
+
+    # Start time lives on the execution context, failed queries leave nothing
+    def before(
+        conn: Any, cursor: Any, statement: str, params: Any, context: Any, *_: Any
+    ):
+        if context is not None:
+            context.deer_pipe_started_at = time.perf_counter()
+
+    def after(
+        conn: Any, cursor: Any, statement: str, params: Any, context: Any, *_: Any
+    ):
+        started_at = getattr(context, "deer_pipe_started_at", None)
+        if started_at is None:
+            return
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement else "?"
+        observe("query", verb, time.perf_counter() - started_at)
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+
+
+def register_cache(name: str, cache: LRUCache[Any, Any]):
+    """
+    Report hit ratio & size of a cache
+
+    :param name: Cache name
+    :param cache: Cache
+    """
+    _caches[name] = cache
+
+
+def register_collector(name: str, func: Callable[[], dict[str, float]]):
+    """
+    Report gauges collected at scrape time
+
+    :param name: Collector name, used as metric prefix
+    :param func: Function returning dict[metric name, value]
+    """
+    _collectors[name] = func
+
+
+def _snapshot():
+    with _lock:
+        return {k: tuple(v) for k, v in _series.items()}
+
+
+def render_prometheus():
+    """
+    Render all metrics in Prometheus text format
+
+    :return: Exposition text
+    """
+    lines: list[str] = []
+
+    # Durations
+    series = _snapshot()
+    for family, text in (
+        ("command", "Time spent handling commands"),
+        ("stage", "Time spent in hot path stages"),
+        ("query", "Time spent in database queries"),
+    ):
+        name = f"deer_pipe_{family}_seconds"
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} summary")
+        for (f, label), (count, total, _) in sorted(series.items()):
+            if f == family:
+                lines.append(f'{name}_count{{{family}="{label}"}} {count:.0f}')
+                lines.append(f'{name}_sum{{{family}="{label}"}} {total:.6f}')
+        lines.append(f"# TYPE {name}_max gauge")
+        for (f, label), (_, _, peak) in sorted(series.items()):
+            if f == family:
+                lines.append(f'{name}_max{{{family}="{label}"}} {peak:.6f}')
+
+    # Caches
+    for metric, kind, attr in (
+        ("deer_pipe_cache_hits_total", "counter", "hits"),
+        ("deer_pipe_cache_misses_total", "counter", "misses"),
+        ("deer_pipe_cache_entries", "gauge", None),
+        ("deer_pipe_cache_bytes", "gauge", "nbytes"),
+    ):
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, cache in sorted(_caches.items()):
+            value = len(cache) if attr is None else getattr(cache, attr)
+            lines.append(f'{metric}{{cache="{name}"}} {value}')
+
+    # Collected gauges
+    for prefix, func in sorted(_collectors.items()):
+        for key, value in func().items():
+            lines.append(f"# TYPE deer_pipe_{prefix}_{key} gauge")
+            lines.append(f"deer_pipe_{prefix}_{key} {float(value):g}")
+
+    return "\n".join(lines) + "\n"
+
+
+def render_summary():
+    """
+    Render metrics as human readable text
+
+    :return: Summary text
+    """
+    lines: list[str] = []
+
+    # Durations
+    if ENABLED:
+        series = _snapshot()
+        for family, title in (
+            ("command", "命令耗时"),
+            ("stage", "阶段耗时"),
+            ("query", "数据库查询"),
+        ):
+            lines.append(f"== {title} ==")
+            for (f, label), (count, total, peak) in sorted(series.items()):
+                if f == family:
+                    lines.append(
+                        f"{label}: {count:.0f}次 "
+                        f"平均{total / count * 1000:.1f}ms 最大{peak * 1000:.1f}ms"
+                    )
+    else:
+        lines.append("* 耗时统计未启用（DEER_PIPE_METRICS）")
+
+    # Caches
+    lines.append("== 缓存命中率 ==")
+    for name, cache in sorted(_caches.items()):
+        lookups = cache.hits + cache.misses
+        ratio = f"{cache.hits / lookups:.1%}" if lookups else "-"
+        lines.append(f"{name}: {ratio} ({len(cache)}项)")
+
+    # Collected gauges
+    for prefix, func in sorted(_collectors.items()):
+        lines.append(f"== {prefix} ==")
+        lines.extend(f"{key}: {value:g}" for key, value in func().items())
+
+    return "\n".join(lines)
+
+
+async def _handle(_: Request):
+    return Response(
+        200,
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        content=render_prometheus(),
+    )
+
+
+# Serve Prometheus endpoint
+_driver = get_driver()
+if ENABLED and plugin_config.deer_pipe_metrics_path:
+    if isinstance(_driver, ASGIMixin):
+        _driver.setup_http_server(
+            HTTPServerSetup(
+                URL(plugin_config.deer_pipe_metrics_path),
+                "GET",
+                "deer_pipe_metrics",
+                _handle,
+            )
+        )
+    else:
+        logger.warning("Driver can't serve HTTP, metrics endpoint is disabled")
@@ -0,0 +1,119 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from multidict import CIMultiDictProxy
+    from typing import Any
+
+
+import asyncio
+import json
+import random
+
+from .config import plugin_config
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from dataclasses import dataclass
+from nonebot import get_driver
+from nonebot.log import logger
+
+
+class ResponseTooLargeError(Exception):
+    """Response body exceeds size limit"""
+
+
+@dataclass
+class Response:
+    status: int
+    headers: CIMultiDictProxy[str]
+    body: bytes
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+# Retryable status codes
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Global variables
+_session: ClientSession | None = None
+
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = ClientSession(
+            connector=TCPConnector(
+                limit=plugin_config.deer_pipe_http_limit,
+                limit_per_host=plugin_config.deer_pipe_http_limit_per_host,
+                ttl_dns_cache=300,
+            ),
+            timeout=ClientTimeout(
+                connect=plugin_config.deer_pipe_http_connect_timeout,
+                sock_read=plugin_config.deer_pipe_http_read_timeout,
+            ),
+        )
+    return _session
+
+
+async def _read(url: str, headers: dict[str, str] | None, max_size: int):
+    async with _get_session().get(url, headers=headers) as resp:
+        if resp.status in _RETRY_STATUS:
+            resp.raise_for_status()
+
+        # Check size before and while reading
+        if (resp.content_length or 0) > max_size:
+            raise ResponseTooLargeError(f"{resp.content_length} > {max_size} bytes")
+        body = bytearray()
+        async for chunk in resp.content.iter_chunked(65536):
+            body += chunk
+            if len(body) > max_size:
+                raise ResponseTooLargeError(f"More than {max_size} bytes")
+
+        return Response(resp.status, resp.headers, bytes(body))
+
+
+async def fetch(
+    url: str,
+    *,
+    headers: dict[str, str] | None = None,
+    max_size: int | None = None,
+):
+    """
+    Send GET request with shared client, retrying with exponential backoff
+
+    Only connection errors, timeouts and 429/5xx responses are retried.
+
+    :param url: URL
+    :param headers: Optional request headers
+    :param max_size: Max body size, default to config
+    :raises ClientError: Request failed
+    :raises ResponseTooLargeError: Response body too large
+    :return: Response
+    """
+    retries = plugin_config.deer_pipe_http_retries
+    max_size = max_size or plugin_config.deer_pipe_http_max_size
+    for i in range(retries + 1):
+        try:
+            return await _read(url, headers, max_size)
+        except (ClientError, asyncio.TimeoutError) as e:
+            if i == retries:
+                raise
+
+            # Full jitter backoff
+            delay = random.uniform(0, plugin_config.deer_pipe_http_backoff * 2**i)
+            logger.warning(
+                f"Error requesting '{url}', retry {i + 1}/{retries} "
+                f"in {delay:.2f}s: {e!r}"
+            )
+            await asyncio.sleep(delay)
+
+    raise AssertionError("unreachable")
+
+
+# Hooks
+@get_driver().on_shutdown
+async def _():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
@@ -0,0 +1,247 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .config import ImageFormat
+    from PIL import Image
+    from concurrent.futures import Executor
+    from datetime import datetime
+    from typing import Any, Callable, Hashable
+
+
+import asyncio
+import hashlib
+import multiprocessing
+import time
+
+from .cache import LRUCache
+from .config import plugin_config
+from .image import gen_calendar, gen_rank, warmup
+from .metrics import observe, register_cache, register_collector
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from nonebot import get_driver
+from nonebot.log import logger
+
+
+class RenderBusyError(Exception):
+    """Render queue is full"""
+
+
+@dataclass
+class RenderMetrics:
+    rendered: int = 0
+    rejected: int = 0
+    failed: int = 0
+    queue_wait_total: float = 0.0
+    queue_wait_max: float = 0.0
+    render_total: float = 0.0
+    render_max: float = 0.0
+
+
+# Global variables
+_executor: Executor | None = None
+_warmup_task: asyncio.Task[None] | None = None
+_semaphore = asyncio.Semaphore(plugin_config.deer_pipe_render_workers)
+_pending = 0
+_metrics = RenderMetrics()
+
+# Encoded images keyed by (invalidation tag, input fingerprint)
+_images: LRUCache[tuple[Hashable, bytes], bytes] = LRUCache(
+    plugin_config.deer_pipe_image_cache_size,
+    maxbytes=plugin_config.deer_pipe_image_cache_bytes,
+    sizeof=len,
+)
+register_cache("images", _images)
+
+
+def _get_executor():
+    global _executor
+    if _executor is not None:
+        return _executor
+
+    workers = plugin_config.deer_pipe_render_workers
+    if plugin_config.deer_pipe_render_executor == "process":
+        # Worker processes must inherit the loaded plugin, so only fork works
+        if "fork" in multiprocessing.get_all_start_methods():
+            _executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("fork")
+            )
+            return _executor
+        logger.warning("Process render executor needs fork, fallback to threads")
+
+    _executor = ThreadPoolExecutor(workers, thread_name_prefix="deer_pipe_render")
+    return _executor
+
+
+async def _submit(func: Callable[..., bytes], *args: Any):
+    global _pending
+
+    # Apply backpressure
+    limit = plugin_config.deer_pipe_render_workers
+    limit += plugin_config.deer_pipe_render_queue_size
+    if _pending >= limit:
+        _metrics.rejected += 1
+        raise RenderBusyError(f"Render queue is full ({_pending}/{limit})")
+
+    _pending += 1
+    try:
+        # Wait for a free worker
+        queued_at = time.perf_counter()
+        async with _semaphore:
+            started_at = time.perf_counter()
+            wait = started_at - queued_at
+            _metrics.queue_wait_total += wait
+            _metrics.queue_wait_max = max(_metrics.queue_wait_max, wait)
+            observe("stage", "render_wait", wait)
+
+            # Render in worker
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(_get_executor(), func, *args)
+            except Exception:
+                _metrics.failed += 1
+                raise
+
+            elapsed = time.perf_counter() - started_at
+            _metrics.rendered += 1
+            _metrics.render_total += elapsed
+            _metrics.render_max = max(_metrics.render_max, elapsed)
+            observe("stage", "render", elapsed)
+            return result
+    finally:
+        _pending -= 1
+
+
+def _fingerprint(*parts: Any):
+    h = hashlib.blake2b(repr(parts).encode(), digest_size=16)
+    return h.digest()
+
+
+def _avatar_digest(avatar: Image.Image | None):
+    # Avatars without digest can't be fingerprinted
+    return "" if avatar is None else avatar.info.get("digest")
+
+
+async def _cached(
+    tag: Hashable,
+    parts: tuple[Any, ...] | None,
+    func: Callable[..., bytes],
+    *args: Any,
+):
+    if parts is None:
+        return await _submit(func, *args)
+
+    key = (tag, _fingerprint(*parts))
+    img = _images.get(key)
+    if img is None:
+        img = await _submit(func, *args)
+        _images.put(key, img)
+    return img
+
+
+def invalidate_images(*tags: Hashable):
+    """
+    Drop cached images with any of the given tags
+
+    :param tags: Invalidation tags
+    """
+    drop = set(tags)
+    _images.discard_if(lambda key: key[0] in drop)
+
+
+async def render_calendar(
+    now: datetime,
+    records: dict[int, int],
+    name: str,
+    avatar: Image.Image | None,
+    fmt: ImageFormat = "png",
+    tag: Hashable = None,
+    streak: tuple[int, int] | None = None,
+):
+    """
+    Generate calendar image in render worker, or reuse a cached one
+
+    :param now: Current time
+    :param records: dict[day, count]
+    :param name: User name
+    :param avatar: Optional user avatar
+    :param fmt: Output format
+    :param tag: Cache invalidation tag
+    :param streak: Optional tuple[current streak, longest streak]
+    :raises RenderBusyError: Render queue is full
+    :return: Image bytes
+    """
+    digest = _avatar_digest(avatar)
+    parts = None
+    if digest is not None:
+        parts = (
+            "calendar",
+            now.year,
+            now.month,
+            sorted(records.items()),
+            name,
+            digest,
+            fmt,
+            streak,
+        )
+    return await _cached(
+        tag, parts, gen_calendar, now, records, name, avatar, fmt, streak
+    )
+
+
+async def render_rank(
+    rank: list[tuple[str, Image.Image | None, int]],
+    title: str = "本月Top5🦌榜",
+    start: int = 1,
+    footer: str | None = None,
+    fmt: ImageFormat = "png",
+    tag: Hashable = None,
+):
+    """
+    Generate rank image in render worker, or reuse a cached one
+
+    :param rank: list[tuple[name, avatar, count]]
+    :param title: Title text
+    :param start: Rank position of the first entry
+    :param footer: Optional footer text
+    :param fmt: Output format
+    :param tag: Cache invalidation tag
+    :raises RenderBusyError: Render queue is full
+    :return: Image bytes
+    """
+    entries = [(name, _avatar_digest(avatar), count) for name, avatar, count in rank]
+    parts = None
+    if all(i[1] is not None for i in entries):
+        parts = ("rank", entries, title, start, footer, fmt)
+    return await _cached(tag, parts, gen_rank, rank, title, start, footer, fmt)
+
+
+register_collector("render", lambda: {**asdict(_metrics), "pending": _pending})
+
+
+# Hooks
+@get_driver().on_startup
+async def _():
+    global _warmup_task
+    if not plugin_config.deer_pipe_warmup:
+        return
+
+    async def run():
+        try:
+            started_at = time.perf_counter()
+            await asyncio.to_thread(warmup)
+            elapsed = time.perf_counter() - started_at
+            logger.info(f"Render assets warmed up in {elapsed:.3f}s")
+        except Exception as e:
+            logger.warning(f"Fail to warm up render assets: {e}")
+
+    _warmup_task = asyncio.create_task(run())
+
+
+@get_driver().on_shutdown
+async def _():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
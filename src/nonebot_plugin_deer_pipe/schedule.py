@@ -1,18 +1,16 @@
-import asyncio
-
-from .database import cleanup
-from aiohttp import ClientSession
-from importlib_metadata import version
+from .constants import get_plugin_version
+from .network import fetch
+from .storage import storage
 from nonebot.log import logger
 from nonebot_plugin_apscheduler import scheduler
 
 # Global variables
-_latest_version = version("nonebot_plugin_deer_pipe")
+_latest_version: str | None = None
 
 
 # Getter
 def get_latest_version():
-    return _latest_version
+    return _latest_version or get_plugin_version()
 
 
 # Jobs
@@ -23,26 +21,22 @@ async def _():
     """Fetch latest version"""
     global _latest_version
 
-    async with ClientSession() as session:
-        for i in range(3):
-            try:
-                async with session.get(
-                    "https://pypi.org/pypi/nonebot-plugin-deer-pipe/json"
-                ) as resp:
-                    resp.raise_for_status()
-                    data = await resp.json()
-                    _latest_version = data["info"]["version"]
-                    logger.info(f"Latest version fetched: v{_latest_version}")
-                    return
-            except Exception as e:
-                logger.warning(f"Error fetching latest version, retry {i}/3: {e}")
-                await asyncio.sleep(1)
-    logger.error("Fail to fetch latest version")
+    try:
+        resp = await fetch("https://pypi.org/pypi/nonebot-plugin-deer-pipe/json")
+        if resp.status != 200:
+            raise ValueError(f"HTTP {resp.status}")
+        _latest_version = resp.json()["info"]["version"]
+        logger.info(f"Latest version fetched: v{_latest_version}")
+    except Exception as e:
+        logger.error(f"Fail to fetch latest version: {e!r}")
 
 
 @scheduler.scheduled_job(
     "cron", day_of_week="mon", hour=4, id="nonebot_plugin_deer_pipe_scheduler_cleanup"
 )
 async def _():
-    await cleanup()
-    logger.info("Database cleaned")
+    report = await storage.cleanup()
+    logger.info(
+        f"Database cleaned: {report.compacted} day records compacted, "
+        f"{report.users} orphaned users deleted in {report.elapsed:.3f}s"
+    )
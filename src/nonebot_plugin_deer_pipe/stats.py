@@ -0,0 +1,150 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from nonebot_plugin_uninfo import Session
+
+
+import calendar
+
+from .database import get_scene_month, get_scene_year
+from .metrics import timed
+from .streak import longest_run, run_until
+from array import array
+from dataclasses import dataclass
+
+
+class _UserColumns:
+    user_ids: list[str]
+
+    def index(self, user_id: str):
+        """
+        Get array index of user
+
+        :param user_id: User ID
+        :return: Index or None if user hasn't checked in
+        """
+        try:
+            return self.user_ids.index(user_id)
+        except ValueError:
+            return None
+
+    def top(self, column: array[int]):
+        """
+        Get index of the largest value, the first one on ties
+
+        :param column: Non-empty per-user array
+        :return: Index
+        """
+        return max(range(len(column)), key=column.__getitem__)
+
+
+@dataclass
+class MonthStats(_UserColumns):
+    """Deer aggregates of a scene month, one array element per user"""
+
+    year: int
+    month: int
+    user_ids: list[str]
+    counts: array[int]
+    days: array[int]
+    longest: array[int]
+    current: array[int]
+    day_counts: array[int]
+    day_users: array[int]
+
+    def busiest_day(self):
+        """
+        Get day with most deer counts, the first one on ties
+
+        :return: Day
+        """
+        return max(range(1, len(self.day_counts)), key=self.day_counts.__getitem__)
+
+    def weekdays(self):
+        """
+        Get deer counts by weekday
+
+        :return: Array of counts, Monday first
+        """
+        first = calendar.weekday(self.year, self.month, 1)
+        hist = array("q", [0]) * 7
+        for day in range(1, len(self.day_counts)):
+            hist[(first + day - 1) % 7] += self.day_counts[day]
+        return hist
+
+
+@dataclass
+class YearStats(_UserColumns):
+    """Deer aggregates of a scene year, one array element per user"""
+
+    year: int
+    user_ids: list[str]
+    counts: array[int]
+    days: array[int]
+    month_counts: array[int]
+
+
+@timed("month_stats")
+async def get_month_stats(session: Session, year: int, month: int, today: int):
+    """
+    Get deer statistics of a scene month
+
+    Streaks count consecutive days within the month. A current streak may end
+    today or yesterday, since today's check-in can still come.
+
+    :param session: Uninfo session
+    :param year: Year
+    :param month: Month
+    :param today: Day current streaks end at
+    :return: Month statistics
+    """
+    users, days = await get_scene_month(session, year, month)
+
+    masks = [i[3] for i in users]
+    day_counts = array("q", [0]) * (calendar.monthrange(year, month)[1] + 1)
+    day_users = array("q", [0]) * len(day_counts)
+    for day, count, checked in days:
+        day_counts[day] = count
+        day_users[day] = checked
+
+    return MonthStats(
+        year,
+        month,
+        [i[0] for i in users],
+        array("q", (i[1] for i in users)),
+        array("q", (i[2] for i in users)),
+        array("q", map(longest_run, masks)),
+        array("q", (max(run_until(i, today), run_until(i, today - 1)) for i in masks)),
+        day_counts,
+        day_users,
+    )
+
+
+@timed("year_stats")
+async def get_year_stats(session: Session, year: int):
+    """
+    Get deer statistics of a scene year
+
+    :param session: Uninfo session
+    :param year: Year
+    :return: Year statistics
+    """
+    rows = await get_scene_year(session, year)
+
+    # Merge months into per-user columns
+    index: dict[str, int] = {}
+    counts = array("q")
+    days = array("q")
+    month_counts = array("q", [0]) * 13
+    for user_id, month, count, checked in rows:
+        i = index.get(user_id)
+        if i is None:
+            i = index[user_id] = len(counts)
+            counts.append(0)
+            days.append(0)
+        counts[i] += count
+        days[i] += checked
+        month_counts[month] += count
+
+    return YearStats(year, list(index), counts, days, month_counts)
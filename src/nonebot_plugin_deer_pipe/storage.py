@@ -0,0 +1,49 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .database import CleanupReport, User
+    from .streak import Streak
+    from datetime import datetime
+    from nonebot_plugin_uninfo import Session
+
+
+from . import database
+from typing import Protocol
+
+
+class Storage(Protocol):
+    """
+    Deer record storage used by commands & scheduled jobs
+
+    A backend keeps its schema, caches and dialect fast paths behind these
+    calls. Maintenance like rebuilds, import & export is backend specific and
+    stays out of it.
+    """
+
+    async def get_user(self, session: Session, user_id: str) -> User: ...
+
+    async def update_user(self, user: User) -> None: ...
+
+    async def check_in(
+        self, now: datetime, user: User, day: int | None = None
+    ) -> tuple[bool, dict[int, int]]: ...
+
+    async def get_records(self, now: datetime, user: User) -> dict[int, int]: ...
+
+    async def get_streak(self, user: User) -> Streak: ...
+
+    async def get_rank(
+        self,
+        session: Session,
+        now: datetime,
+        limit: int = 5,
+        offset: int = 0,
+        user_id: str | None = None,
+    ) -> tuple[list[tuple[str, int]], tuple[int, int] | None, int]: ...
+
+    async def cleanup(self) -> CleanupReport: ...
+
+
+# SQLAlchemy storage over the configured database URL
+storage: Storage = database
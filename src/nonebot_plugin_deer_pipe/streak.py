@@ -0,0 +1,143 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Iterable
+
+
+from calendar import monthrange
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+
+def longest_run(mask: int):
+    """
+    Get length of the longest run of set bits
+
+    :param mask: Bitmask of checked days
+    :return: Run length
+    """
+    # Every step shortens all runs by one bit at once
+    length = 0
+    while mask:
+        mask &= mask >> 1
+        length += 1
+    return length
+
+
+def run_until(mask: int, day: int):
+    """
+    Get length of the run of set bits ending at given day
+
+    :param mask: Bitmask of checked days, bit 0 unset
+    :param day: Last day of run
+    :return: Run length
+    """
+    # The highest unset bit at or below day starts the run
+    unset = ~mask & ((2 << day) - 1)
+    return day - unset.bit_length() + 1
+
+
+def run_from(mask: int, day: int):
+    """
+    Get length of the run of set bits starting at given day
+
+    :param mask: Bitmask of checked days
+    :param day: First day of run
+    :return: Run length
+    """
+    # Isolate the lowest unset bit from day on
+    rest = mask >> day
+    return (~rest & (rest + 1)).bit_length() - 1
+
+
+@dataclass(frozen=True)
+class Streak:
+    """Consecutive check-in days ending at the last checked day"""
+
+    current: int = 0
+    longest: int = 0
+    last_day: date | None = None
+
+    def on(self, today: date):
+        """
+        Get current streak, broken if neither today nor yesterday is checked
+
+        :param today: Current date
+        :return: Streak length
+        """
+        if self.last_day is None or self.last_day < today - timedelta(days=1):
+            return 0
+        return self.current
+
+    def add(self, day: date, before: int = 0, after: int = 0):
+        """
+        Apply a newly checked day
+
+        :param day: Checked day
+        :param before: Checked days right before it, for days before last day
+        :param after: Checked days right after it, for days before last day
+        :return: New streak
+        """
+        # Latest day extends or restarts current streak
+        if self.last_day is None or day > self.last_day:
+            chained = self.last_day == day - timedelta(days=1)
+            current = self.current + 1 if chained else 1
+            return Streak(current, max(self.longest, current), day)
+        if day == self.last_day:
+            return self
+
+        # Past day joins the runs around it
+        joined = before + 1 + after
+        current = self.current
+        if day + timedelta(days=after) == self.last_day:
+            current += before + 1
+        return Streak(current, max(self.longest, joined, current), self.last_day)
+
+
+def rebuild(
+    months: Iterable[tuple[int, int, int | None, int]], stored: Streak | None = None
+):
+    """
+    Rebuild streak from chronological months
+
+    Months compacted before summaries kept a bitmask only have checked day
+    counts, so runs inside a partially checked one are unknown. Longer stored
+    streaks are kept in that case.
+
+    :param months: Iterable of tuple[year, month, bitmask of checked days or
+        None if unknown, checked days]
+    :param stored: Stored streak
+    :return: Rebuilt streak
+    """
+    current, best, last_day = 0, 0, None
+    lossy = False
+    for year, month, mask, days in months:
+        length = monthrange(year, month)[1]
+
+        # Fully checked month without bitmask
+        if mask is None and days >= length:
+            mask = (2 << length) - 2
+        if mask is None:
+            if days > 0:
+                lossy = True
+                current, best, last_day = 0, max(best, 1), None
+            continue
+        if mask == 0:
+            continue
+
+        # Chain with previous month
+        first = date(year, month, 1)
+        chained = current if last_day == first - timedelta(days=1) else 0
+        lead = run_from(mask, 1)
+        end = mask.bit_length() - 1
+        best = max(best, longest_run(mask), chained + lead)
+
+        current = chained + end if lead >= end else run_until(mask, end)
+        last_day = date(year, month, end)
+
+    if lossy and stored is not None:
+        if stored.last_day == last_day:
+            current = max(current, stored.current)
+        best = max(best, stored.longest)
+    return Streak(current, best, last_day)
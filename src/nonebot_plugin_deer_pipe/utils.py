@@ -2,48 +2,67 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
+    from PIL import Image
     from datetime import datetime
     from nonebot_plugin_uninfo import QryItrface, Session
 
 
 import asyncio
 
-from .database import get_rank, get_user
-from aiohttp import ClientSession
-from aiocache import cached as real_cached
+from .config import plugin_config
+from .avatar import get_avatar
+from .metrics import timed
+from .storage import storage
 from nonebot.log import logger
 
 
-# Fix type hint
-if TYPE_CHECKING:
+async def _dl_avatar(url: str | None):
+    """
+    Get avatar within timeout
 
-    def cached(*args, **kwargs):
-        def wrapper(func):
-            return func
+    :param url: Optional avatar URL
+    :return: Avatar image or None to use default avatar
+    """
+    if url is None:
+        return None
 
-        return wrapper
-else:
-    cached = real_cached
+    try:
+        return await asyncio.wait_for(
+            get_avatar(url), plugin_config.deer_pipe_avatar_timeout
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Timeout downloading avatar '{url}', use default avatar")
+        return None
 
 
-@cached(ttl=86400)
-async def dl_img(url: str):
+async def _get_member(session: Session, interface: QryItrface, user_id: str):
     """
-    Download image by URL with 1day caching
+    Get member name and avatar URL
 
-    :param url: Image URL
+    :param session: Uninfo session
+    :param interface: Uninfo query interface
+    :param user_id: User ID
+    :return: tuple[name, avatar URL]
     """
-    async with ClientSession() as session:
-        for i in range(3):
-            try:
-                async with session.get(url) as response:
-                    response.raise_for_status()
-                    return await response.read()
-            except Exception as e:
-                logger.warning(f"Error downloading '{url}', retry {i}/3: {e}")
-                await asyncio.sleep(1)
+    try:
+        member = await asyncio.wait_for(
+            interface.get_member(session.scene.type, session.scene.id, user_id),
+            plugin_config.deer_pipe_avatar_timeout,
+        )
+    except Exception:
+        member = None
+
+    name = (
+        (None if member is None else member.nick)
+        or (None if member is None else member.user.nick)
+        or (None if member is None else member.user.name)
+        or user_id
+    )
+    avatar_url = None if member is None else member.user.avatar
+    return (name, avatar_url)
 
 
+@timed("get_user_info")
 async def get_user_info(session: Session):
     """
     Get user info from session
@@ -57,11 +76,13 @@ async def get_user_info(session: Session):
         or session.user.name
         or session.user.id
     )
-    avatar = None if session.user.avatar is None else await dl_img(session.user.avatar)
-    user = await get_user(session, session.user.id)
+    avatar, user = await asyncio.gather(
+        _dl_avatar(session.user.avatar), storage.get_user(session, session.user.id)
+    )
     return (name, avatar, user)
 
 
+@timed("get_member_info")
 async def get_member_info(session: Session, interface: QryItrface, user_id: str):
     """
     Get member info from session
@@ -71,52 +92,81 @@ async def get_member_info(session: Session, interface: QryItrface, user_id: str)
     :param user_id: User ID
     :return: tuple[name, avatar, User]
     """
-    try:
-        member = await interface.get_member(
-            session.scene.type, session.scene.id, user_id
-        )
-    except Exception:
-        member = None
 
-    name = (
-        (None if member is None else member.nick)
-        or (None if member is None else member.user.nick)
-        or (None if member is None else member.user.name)
-        or user_id
+    async def get_info():
+        name, avatar_url = await _get_member(session, interface, user_id)
+        return (name, await _dl_avatar(avatar_url))
+
+    (name, avatar), user = await asyncio.gather(
+        get_info(), storage.get_user(session, user_id)
     )
-    avatar_url = None if member is None else member.user.avatar
-    avatar = None if avatar_url is None else await dl_img(avatar_url)
-    user = await get_user(session, user_id)
     return (name, avatar, user)
 
 
-async def get_member_rank(session: Session, interface: QryItrface, now: datetime):
+async def get_member_names(
+    session: Session, interface: QryItrface, user_ids: list[str]
+):
+    """
+    Get member names concurrently
+
+    :param session: Uninfo session
+    :param interface: Uninfo query interface
+    :param user_ids: User IDs
+    :return: dict[user ID, name]
+    """
+    user_ids = list(set(user_ids))
+    members = await asyncio.gather(
+        *(_get_member(session, interface, i) for i in user_ids)
+    )
+    return {i: name for i, (name, _) in zip(user_ids, members)}
+
+
+@timed("get_member_rank")
+async def get_member_rank(
+    session: Session,
+    interface: QryItrface,
+    now: datetime,
+    limit: int = 5,
+    offset: int = 0,
+    user_id: str | None = None,
+):
     """
     Get rank with member info
 
     :param session: Uninfo session
     :param interface: Uninfo query interface
     :param now: Current time
-    :return: list[tuple[name, avatar, count]]
+    :param limit: Max entry count
+    :param offset: Entries to skip
+    :param user_id: Optional user ID to get own rank
+    :return: tuple[list[tuple[name, avatar, count]], own rank, total]
     """
+    semaphore = asyncio.Semaphore(plugin_config.deer_pipe_fetch_concurrency)
 
     async def get_info(user_id: str):
-        try:
-            member = await interface.get_member(
-                session.scene.type, session.scene.id, user_id
-            )
-        except Exception:
-            member = None
-
-        name = (
-            (None if member is None else member.nick)
-            or (None if member is None else member.user.nick)
-            or (None if member is None else member.user.name)
-            or user_id
-        )
-        avatar_url = None if member is None else member.user.avatar
-        avatar = None if avatar_url is None else await dl_img(avatar_url)
-        return (name, avatar)
-
-    rank = await get_rank(session, now)
-    return [(*(await get_info(i[0])), i[1]) for i in rank]
+        async with semaphore:
+            name, avatar_url = await _get_member(session, interface, user_id)
+            return (name, await _dl_avatar(avatar_url))
+
+    rank, own, total = await storage.get_rank(session, now, limit, offset, user_id)
+    if len(rank) == 0:
+        return ([], own, total)
+
+    # Fetch concurrently until deadline
+    tasks = [asyncio.create_task(get_info(i[0])) for i in rank]
+    _, pending = await asyncio.wait(
+        tasks, timeout=plugin_config.deer_pipe_fetch_deadline
+    )
+    for task in pending:
+        task.cancel()
+    if len(pending) > 0:
+        logger.warning(f"Fetching {len(pending)} rank member info timeout")
+
+    # Fallback to user ID & default avatar
+    entries: list[tuple[str, Image.Image | None, int]] = []
+    for (user_id, count), task in zip(rank, tasks):
+        if task in pending or task.exception() is not None:
+            entries.append((user_id, None, count))
+        else:
+            entries.append((*task.result(), count))
+    return (entries, own, total)
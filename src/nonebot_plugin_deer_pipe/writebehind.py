@@ -0,0 +1,265 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+    from typing import TextIO
+
+
+import asyncio
+import json
+import os
+
+from collections import defaultdict
+from uuid import UUID
+
+
+# Type alias
+MonthKey = tuple[UUID, int, int]
+DayKey = tuple[UUID, int, int, int]
+
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_journal(fd: int, directory: Path | None):
+    try:
+        os.fsync(fd)
+        if directory is not None:
+            _fsync_dir(directory)
+    finally:
+        os.close(fd)
+
+
+class WriteBehindBuffer:
+    """
+    In-memory per-user month states with pending check-in deltas
+
+    Every delta is appended & fsynced to a journal before it is acknowledged,
+    so it survives a power loss as well as a process crash. Fsyncs run in a
+    worker thread, and check-ins arriving meanwhile share the next one.
+
+    Each journal segment starts with a sequence number. Taking the pending
+    deltas rotates the journal to a file named by it, so rotated segments hold
+    exactly the deltas of the flush in progress, and committing the sequence
+    along with them lets recovery skip segments already in database.
+    """
+
+    def __init__(self, journal: Path, max_months: int = 4096):
+        self.max_months = max_months
+        self._months: dict[MonthKey, dict[int, int]] = {}
+        self._pending: defaultdict[DayKey, int] = defaultdict(int)
+        self._path = journal
+        self._rotated: list[Path] = []
+        self._journal: TextIO | None = None
+        self._seq = 0
+
+        # Appends written & fsynced, directory of a new segment to fsync
+        self._written = 0
+        self._synced = 0
+        self._sync_dir = False
+        self._sync_task: asyncio.Task[None] | None = None
+
+    def __contains__(self, key: MonthKey):
+        return key in self._months
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _write(self, deltas: dict[DayKey, int]):
+        if self._journal is None:
+            self._journal = self._path.open("a", encoding="utf-8")
+            self._seq += 1
+            self._journal.write(json.dumps([self._seq]))
+            self._journal.write("\n")
+
+            # A new file also needs its directory entry persisted
+            self._sync_dir = True
+        for (user_uuid, year, month, day), count in deltas.items():
+            self._journal.write(json.dumps([user_uuid.hex, year, month, day, count]))
+            self._journal.write("\n")
+        self._journal.flush()
+        self._written += 1
+
+    async def _fsync(self):
+        try:
+            written = self._written
+            if self._journal is not None:
+                directory = self._path.parent if self._sync_dir else None
+                self._sync_dir = False
+                try:
+                    await asyncio.to_thread(
+                        _fsync_journal, os.dup(self._journal.fileno()), directory
+                    )
+                except BaseException:
+                    self._sync_dir = self._sync_dir or directory is not None
+                    raise
+            self._synced = written
+        finally:
+            self._sync_task = None
+
+    async def sync(self):
+        """Wait until all appended deltas are fsynced"""
+        while self._synced < self._written:
+            # Join the fsync in progress, or start one for all appends so far
+            if self._sync_task is None:
+                self._sync_task = asyncio.create_task(self._fsync())
+            await asyncio.shield(self._sync_task)
+
+    def _segments(self):
+        # Rotated segments in sequence order, then the current one
+        segments: list[tuple[int, Path]] = []
+        for path in self._path.parent.glob(f"{self._path.name}.*"):
+            if path.suffix[1:].isdigit():
+                segments.append((int(path.suffix[1:]), path))
+        return [i[1] for i in sorted(segments)] + [self._path]
+
+    def recover(self, committed: int):
+        """
+        Read deltas left by an unclean shutdown
+
+        :param committed: Sequence of last segment committed to database
+        :return: tuple[dict[(user UUID, year, month, day), count delta],
+            sequence of last replayed segment or None]
+        """
+        deltas: defaultdict[DayKey, int] = defaultdict(int)
+        last = None
+        self._seq = committed
+        for path in self._segments():
+            if not path.exists():
+                continue
+
+            # Segments without sequence predate it and are never committed
+            seq = None
+            for line in path.read_text(encoding="utf-8").splitlines():
+                try:
+                    item = json.loads(line)
+                    if len(item) == 1:
+                        seq = int(item[0])
+                        self._seq = max(self._seq, seq)
+                        continue
+                    if seq is not None and seq <= committed:
+                        continue
+                    user_uuid, year, month, day, count = item
+                except (TypeError, ValueError):
+                    # Torn write of the last line
+                    continue
+                deltas[(UUID(user_uuid), year, month, day)] += count
+                if seq is not None:
+                    last = max(last or 0, seq)
+        return (dict(deltas), last)
+
+    def reset(self):
+        """Remove journals after recovered deltas are committed"""
+        self.close()
+        for path in self._segments():
+            path.unlink(missing_ok=True)
+        self._rotated.clear()
+
+    def get(self, key: MonthKey):
+        """
+        Get month state
+
+        :param key: (user UUID, year, month)
+        :return: dict[day of month, count] or None if not loaded
+        """
+        records = self._months.get(key)
+        return None if records is None else dict(records)
+
+    def load(self, key: MonthKey, records: dict[int, int]):
+        """
+        Load month state from database, unless already loaded
+
+        :param key: (user UUID, year, month)
+        :param records: dict[day of month, count]
+        """
+        self._months.setdefault(key, dict(records))
+
+    async def check_in(self, key: MonthKey, day: int, increase: bool):
+        """
+        Apply check in to a loaded month state, once its delta is fsynced
+
+        :param key: (user UUID, year, month)
+        :param day: Day of month
+        :param increase: Whether a checked day can be increased
+        :return: tuple[is success, dict[day of month, count]]
+        """
+        records = self._months[key]
+        if not increase and day in records:
+            return (False, dict(records))
+
+        self._write({(*key, day): 1})
+        records[day] = records.get(day, 0) + 1
+        self._pending[(*key, day)] += 1
+        records = dict(records)
+        await self.sync()
+        return (True, records)
+
+    def merge(self, deltas: dict[DayKey, int]):
+        """
+        Add deltas written to database directly into loaded month states
+
+        :param deltas: dict[(user UUID, year, month, day), count delta]
+        """
+        for (user_uuid, year, month, day), count in deltas.items():
+            records = self._months.get((user_uuid, year, month))
+            if records is not None:
+                records[day] = records.get(day, 0) + count
+
+    async def take(self):
+        """
+        Take all pending deltas for flushing
+
+        :return: tuple[dict[(user UUID, year, month, day), count delta],
+            sequence of rotated segment or None]
+        """
+        # Only a fully fsynced segment is rotated
+        await self.sync()
+        deltas = dict(self._pending)
+        self._pending.clear()
+        if self._journal is None:
+            # Retried deltas are still in segments kept by a failed flush
+            return (deltas, self._seq if len(self._rotated) > 0 else None)
+
+        # Rotate journal, and persist the rename before committing
+        seq = self._seq
+        self._journal.close()
+        self._journal = None
+        self._rotated.append(self._path.with_name(f"{self._path.name}.{seq:d}"))
+        self._path.replace(self._rotated[-1])
+        await asyncio.to_thread(_fsync_dir, self._path.parent)
+        return (deltas, seq)
+
+    def done(self, deltas: dict[DayKey, int], ok: bool):
+        """
+        Finish a flush
+
+        :param deltas: Deltas returned by `take`
+        :param ok: Whether deltas are committed
+        """
+        if not ok:
+            # Put deltas back, their rotated segments are kept until a later
+            # flush commits a higher sequence
+            for key, count in deltas.items():
+                self._pending[key] += count
+        else:
+            for path in self._rotated:
+                path.unlink(missing_ok=True)
+            self._rotated.clear()
+
+        # Drop clean month states when too many are loaded
+        if len(self._months) > self.max_months:
+            dirty = {i[:3] for i in self._pending}
+            for key in [i for i in self._months if i not in dirty]:
+                del self._months[key]
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+import nonebot
+import pytest
+
+from nonebot.adapters.console import Adapter
+from types import SimpleNamespace
+
+
+# PostgreSQL cases run only against a given database, e.g.
+# postgresql+asyncpg://postgres@127.0.0.1:5432/deer_test
+PG_URL = os.environ.get("DEER_PIPE_TEST_PG_URL")
+
+
+def pytest_configure():
+    # Keep localstore files out of user directories
+    root = tempfile.mkdtemp(prefix="deer_pipe_test_")
+    nonebot.init(
+        localstore_data_dir=os.path.join(root, "data"),
+        localstore_cache_dir=os.path.join(root, "cache"),
+        localstore_config_dir=os.path.join(root, "config"),
+    )
+    nonebot.get_driver().register_adapter(Adapter)
+    nonebot.load_plugin("nonebot_plugin_deer_pipe")
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+async def database(request: pytest.FixtureRequest, tmp_path, monkeypatch):
+    from nonebot_plugin_deer_pipe import database
+    from nonebot_plugin_deer_pipe.config import plugin_config
+    from sqlmodel import SQLModel
+
+    if request.param == "postgresql":
+        if PG_URL is None:
+            pytest.skip("DEER_PIPE_TEST_PG_URL is not set")
+        url = PG_URL
+    else:
+        url = f"sqlite+aiosqlite:///{tmp_path / 'deer.db'}"
+    monkeypatch.setattr(plugin_config, "deer_pipe_database_url", url)
+
+    # Start from empty tables, a shared database may keep rows of last run
+    await database.init_db()
+    assert database._engine is not None
+    async with database._engine.begin() as conn:
+        for table in reversed(SQLModel.metadata.sorted_tables):
+            await conn.execute(table.delete())
+
+    yield database
+
+    await database.close_db()
+    database._users.clear()
+    database._streaks.clear()
+    database._boards.clear()
+
+
+@pytest.fixture
+def storage(database):
+    from nonebot_plugin_deer_pipe.storage import storage
+
+    return storage
+
+
+@pytest.fixture
+def session():
+    # Only scene fields of uninfo session are used by storage
+    return SimpleNamespace(
+        adapter="Console", scope="Console", scene=SimpleNamespace(id="g")
+    )
@@ -0,0 +1,206 @@
+import asyncio
+
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import col, func, select
+from uuid import uuid4
+
+
+NOW = datetime(2026, 10, 15, 12)
+
+
+async def _count(database, model):
+    async with database._get_session() as db:
+        return await db.scalar(select(func.count()).select_from(model))
+
+
+async def test_get_user_creates_once(database, storage, session):
+    # Concurrent first fetches race on the same unique key
+    users = await asyncio.gather(
+        *(database._fetch_user("Console", "Console", "g", "u") for _ in range(5))
+    )
+    assert len({i.uuid for i in users}) == 1
+    assert await _count(database, database.User) == 1
+
+    # Cached user is a private copy
+    user = await storage.get_user(session, "u")
+    user.can_be_helped = False
+    assert (await storage.get_user(session, "u")).can_be_helped
+    assert user.uuid == users[0].uuid
+
+
+async def test_check_in_upsert(storage, session):
+    user = await storage.get_user(session, "u")
+
+    # Today can be checked repeatedly
+    assert await storage.check_in(NOW, user) == (True, {15: 1})
+    assert await storage.check_in(NOW, user) == (True, {15: 2})
+
+    # Past day only once
+    assert await storage.check_in(NOW, user, 3) == (True, {3: 1, 15: 2})
+    assert await storage.check_in(NOW, user, 3) == (False, {3: 1, 15: 2})
+    assert await storage.get_records(NOW, user) == {3: 1, 15: 2}
+
+    streak = await storage.get_streak(user)
+    assert (streak.current, streak.longest) == (1, 1)
+
+
+async def test_compact_batch(database, storage, session):
+    user = await storage.get_user(session, "u")
+    async with database._get_session() as db:
+        for month, day, count in [(8, 1, 1), (8, 2, 2), (8, 5, 1), (9, 30, 3)]:
+            db.add(
+                database.DeerRecord(
+                    uuid=uuid4(),
+                    user_uuid=user.uuid,
+                    year=2026,
+                    month=month,
+                    day=day,
+                    count=count,
+                )
+            )
+        await db.commit()
+    await storage.check_in(NOW, user)
+
+    # Months split across batches add up in their summary
+    compacted = 0
+    while True:
+        records, _ = await database._compact_batch(NOW, 2)
+        if records == 0:
+            break
+        compacted += records
+    assert compacted == 4
+
+    async with database._get_session() as db:
+        summaries = await db.execute(
+            select(
+                col(database.DeerSummary.month),
+                col(database.DeerSummary.count),
+                col(database.DeerSummary.days),
+            ).order_by(col(database.DeerSummary.month))
+        )
+        assert [tuple(i) for i in summaries] == [(8, 4, 3), (9, 3, 1)]
+    assert await storage.get_records(NOW, user) == {15: 1}
+
+
+async def test_query_rank(database, storage, session):
+    for user_id, days in [("a", [1, 2, 3]), ("b", [4, 5, 6]), ("c", [7])]:
+        user = await storage.get_user(session, user_id)
+        for day in days:
+            await storage.check_in(NOW, user, day)
+    await storage.get_user(session, "d")
+
+    # Tied counts share a rank, pages follow user ID on ties
+    page, own, total = await database._query_rank(session, NOW, 2, 0, "c")
+    assert page == [("a", 3), ("b", 3)]
+    assert own == (3, 1)
+    assert total == 3
+
+    page, own, total = await database._query_rank(session, NOW, 2, 2, "b")
+    assert page == [("c", 1)]
+    assert own == (1, 3)
+
+    page, own, total = await database._query_rank(session, NOW, 5, 0, "d")
+    assert own is None
+
+    # Materialized board agrees with the query
+    assert await storage.get_rank(session, NOW, 5, 0, "c") == (
+        [("a", 3), ("b", 3), ("c", 1)],
+        (3, 1),
+        3,
+    )
+
+
+async def test_ingest_records(database, storage, session, monkeypatch):
+    existing = await storage.get_user(session, "x")
+    await storage.check_in(NOW, existing)
+
+    # Another writer creates a user between lookup & insert
+    execute = AsyncSession.execute
+    calls = 0
+
+    async def racing_execute(self, *args, **kwargs):
+        nonlocal calls
+        res = await execute(self, *args, **kwargs)
+        calls += 1
+        if calls == 1:
+            await database._fetch_user("Console", "Console", "g", "y")
+        return res
+
+    monkeypatch.setattr(AsyncSession, "execute", racing_execute)
+    records, created, uuids = await database.ingest_records(
+        [
+            (("Console", "Console", "g", "x"), 2026, 10, 15, 2),
+            (("Console", "Console", "g", "y"), 2026, 10, 1, 1),
+            (("Console", "Console", "g", "y"), 2026, 10, 1, 1),
+            (("Console", "Console", "g", "z"), 2026, 10, 2, 1),
+        ]
+    )
+    monkeypatch.setattr(AsyncSession, "execute", execute)
+
+    assert (records, created, len(uuids)) == (3, 1, 3)
+    assert await storage.get_records(NOW, existing) == {15: 3}
+    assert await storage.get_records(NOW, await storage.get_user(session, "y")) == {
+        1: 2
+    }
+    assert await _count(database, database.User) == 3
+
+
+async def test_ingest_records_atomic(database, session, monkeypatch):
+    async def fail(*args):
+        raise RuntimeError("write failed")
+
+    # Users aren't created without their records
+    monkeypatch.setattr(database, "_write_deltas", fail)
+    try:
+        await database.ingest_records(
+            [(("Console", "Console", "g", "x"), 2026, 10, 1, 1)]
+        )
+    except RuntimeError:
+        pass
+    assert await _count(database, database.User) == 0
+
+
+async def test_streak_across_compacted_month(database, storage, session):
+    user = await storage.get_user(session, "u")
+    async with database._get_session() as db:
+        for day in range(25, 31):
+            db.add(
+                database.DeerRecord(
+                    uuid=uuid4(), user_uuid=user.uuid, year=2026, month=9, day=day
+                )
+            )
+        await db.commit()
+    for day in range(2, 6):
+        await storage.check_in(NOW, user, day)
+    while (await database._compact_batch(NOW, 100))[0] > 0:
+        pass
+
+    # Backfill joins the run kept in September's summary
+    await storage.check_in(NOW, user, 1)
+    streak = await storage.get_streak(user)
+    assert (streak.current, streak.longest) == (11, 11)
+
+    # Rebuild reads the same run from the summary bitmask
+    await database.recompute_streaks([user.uuid])
+    streak = await storage.get_streak(user)
+    assert (streak.current, streak.longest) == (11, 11)
+
+
+async def test_write_behind_replay_once(
+    database, storage, session, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(database, "DATABASE_JOURNAL_PATH", tmp_path / "journal")
+    await database._start_write_behind()
+    user = await storage.get_user(session, "u")
+    await storage.check_in(NOW, user)
+
+    # Crash after the flush commits, before its journal is removed
+    assert database._buffer is not None and database._flush_task is not None
+    monkeypatch.setattr(database._buffer, "done", lambda *args: None)
+    await database.flush()
+    database._flush_task.cancel()
+    database._buffer.close()
+
+    await database._start_write_behind()
+    assert await storage.get_records(NOW, user) == {15: 1}
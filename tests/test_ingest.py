@@ -0,0 +1,29 @@
+import pytest
+
+
+SCENE = ("Console", "Console", "g")
+
+
+@pytest.mark.parametrize(
+    ("raw", "count"),
+    [
+        ({"user_id": "u", "date": "2026-10-01"}, 1),
+        ({"user_id": "u", "date": "2026-10-01", "count": ""}, 1),
+        ({"user_id": "u", "date": "2026-10-01", "count": "3"}, 3),
+        ('{"user_id": "u", "year": 2026, "month": 10, "day": 1, "count": 2}', 2),
+    ],
+)
+def test_parse_count(raw, count):
+    from nonebot_plugin_deer_pipe.ingest import _parse
+
+    key, year, month, day, parsed = _parse(raw, SCENE)
+    assert (key, year, month, day) == (("Console", "Console", "g", "u"), 2026, 10, 1)
+    assert parsed == count
+
+
+@pytest.mark.parametrize("count", ["0", 0, "-1", "x"])
+def test_parse_invalid_count(count):
+    from nonebot_plugin_deer_pipe.ingest import _parse
+
+    with pytest.raises(ValueError):
+        _parse({"user_id": "u", "date": "2026-10-01", "count": count}, SCENE)
@@ -0,0 +1,26 @@
+import pytest
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+
+def test_failed_query_not_timed(monkeypatch):
+    from nonebot_plugin_deer_pipe import metrics
+
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    monkeypatch.setattr(metrics, "_series", {})
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+
+    with engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.execute(text("SELECT * FROM missing"))
+        conn.execute(text("SELECT 1"))
+        conn.execute(text("CREATE TABLE t (x INTEGER)"))
+
+        # Failed queries leave no start time behind
+        assert not conn.info.get("deer_pipe_started_at")
+
+    # Only completed queries are counted, each under its own verb
+    assert metrics._series[("query", "SELECT")][0] == 1
+    assert metrics._series[("query", "CREATE")][0] == 1
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from aiohttp import ClientResponseError, web
+from aiohttp.test_utils import TestServer
+
+
+@pytest.fixture
+async def server(monkeypatch):
+    from nonebot_plugin_deer_pipe import network
+    from nonebot_plugin_deer_pipe.config import plugin_config
+
+    monkeypatch.setattr(plugin_config, "deer_pipe_http_retries", 2)
+    monkeypatch.setattr(plugin_config, "deer_pipe_http_backoff", 0.01)
+
+    # Status codes to answer in order, the last one repeats
+    calls: list[str] = []
+    statuses: list[int] = []
+
+    async def status(request: web.Request):
+        calls.append(request.path)
+        code = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return web.Response(status=code, body=b"ok")
+
+    async def large(request: web.Request):
+        calls.append(request.path)
+        return web.Response(body=b"x" * 2048)
+
+    async def chunked(request: web.Request):
+        calls.append(request.path)
+        resp = web.StreamResponse()
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        for _ in range(4):
+            await resp.write(b"x" * 512)
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/status", status)
+    app.router.add_get("/large", large)
+    app.router.add_get("/chunked", chunked)
+    async with TestServer(app) as srv:
+        yield (srv, calls, statuses)
+
+    if network._session is not None:
+        await network._session.close()
+        network._session = None
+
+
+async def test_retry_then_success(server, monkeypatch):
+    from nonebot_plugin_deer_pipe.network import fetch
+
+    # Record backoff bounds of every retry
+    bounds: list[float] = []
+    uniform = random.uniform
+
+    def record(a: float, b: float):
+        bounds.append(b)
+        return uniform(a, b)
+
+    monkeypatch.setattr(random, "uniform", record)
+
+    srv, calls, statuses = server
+    statuses.extend([503, 502, 200])
+    resp = await fetch(str(srv.make_url("/status")))
+    assert (resp.status, resp.body) == (200, b"ok")
+    assert len(calls) == 3
+    assert bounds == [0.01, 0.02]
+
+
+async def test_give_up_after_retries(server):
+    from nonebot_plugin_deer_pipe.network import fetch
+
+    srv, calls, statuses = server
+    statuses.append(500)
+    with pytest.raises(ClientResponseError) as e:
+        await fetch(str(srv.make_url("/status")))
+    assert e.value.status == 500
+    assert len(calls) == 3
+
+
+async def test_client_error_not_retried(server):
+    from nonebot_plugin_deer_pipe.network import fetch
+
+    srv, calls, statuses = server
+    statuses.append(404)
+    resp = await fetch(str(srv.make_url("/status")))
+    assert resp.status == 404
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("path", ["/large", "/chunked"])
+async def test_reject_oversized_body(server, path):
+    from nonebot_plugin_deer_pipe.network import ResponseTooLargeError, fetch
+
+    srv, calls, _ = server
+    with pytest.raises(ResponseTooLargeError):
+        await fetch(str(srv.make_url(path)), max_size=1024)
+    assert len(calls) == 1
+
+    # Bodies within limit pass
+    resp = await fetch(str(srv.make_url(path)), max_size=2048)
+    assert len(resp.body) == 2048
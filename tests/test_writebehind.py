@@ -0,0 +1,78 @@
+import asyncio
+import os
+import stat
+import threading
+
+from nonebot_plugin_deer_pipe.writebehind import WriteBehindBuffer
+from uuid import uuid4
+
+
+async def test_group_commit(tmp_path, monkeypatch):
+    # Hold the first journal fsync until later check-ins have queued up
+    calls = 0
+    release = threading.Event()
+    fsync = os.fsync
+
+    def slow_fsync(fd: int):
+        nonlocal calls
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            calls += 1
+            if calls == 1:
+                release.wait(5)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+
+    buffer = WriteBehindBuffer(tmp_path / "journal")
+    buffer.recover(0)
+    keys = [(uuid4(), 2026, 10) for _ in range(4)]
+    for key in keys:
+        buffer.load(key, {})
+
+    first = asyncio.create_task(buffer.check_in(keys[0], 1, True))
+    await asyncio.sleep(0.05)
+    rest = [asyncio.create_task(buffer.check_in(i, 1, True)) for i in keys[1:]]
+    await asyncio.sleep(0.05)
+
+    # Nothing is acknowledged before its fsync
+    assert not any(i.done() for i in [first, *rest])
+    release.set()
+    assert all(i[0] for i in await asyncio.gather(first, *rest))
+    assert calls == 2
+    buffer.close()
+
+
+async def test_replay_skips_committed(tmp_path):
+    buffer = WriteBehindBuffer(tmp_path / "journal")
+    buffer.recover(0)
+    key = (uuid4(), 2026, 10)
+    buffer.load(key, {})
+    await buffer.check_in(key, 1, True)
+
+    # Crash after commit, before the rotated segment is removed
+    deltas, seq = await buffer.take()
+    await buffer.check_in(key, 1, True)
+    buffer.close()
+    assert (deltas, seq) == ({(*key, 1): 1}, 1)
+
+    buffer = WriteBehindBuffer(tmp_path / "journal")
+    assert buffer.recover(1) == ({(*key, 1): 1}, 2)
+    assert buffer.recover(0) == ({(*key, 1): 2}, 2)
+
+
+async def test_failed_flush_keeps_segment(tmp_path):
+    buffer = WriteBehindBuffer(tmp_path / "journal")
+    buffer.recover(0)
+    key = (uuid4(), 2026, 10)
+    buffer.load(key, {})
+    await buffer.check_in(key, 1, True)
+
+    # Retried deltas commit the sequence of their kept segment
+    deltas, seq = await buffer.take()
+    buffer.done(deltas, False)
+    assert await buffer.take() == ({(*key, 1): 1}, seq)
+    buffer.close()
+
+    buffer = WriteBehindBuffer(tmp_path / "journal")
+    assert buffer.recover(0) == ({(*key, 1): 1}, 1)
+    assert buffer.recover(1) == ({}, None)